@@ -1,6 +1,7 @@
 import torch
 import numpy as np
 from torch.utils.data.sampler import BatchSampler, SubsetRandomSampler
+from gesture.agent.memory import gae_returns, discounted_returns
 
 
 class StackedState(object):
@@ -86,18 +87,14 @@ class RolloutStorage(object):
         self.masks[step].copy_(mask)
 
     def compute_returns(self, next_value, use_gae, gamma, tau):
+        num_steps = self.rewards.size(0)
         if use_gae:
             self.value_preds[-1] = next_value
-            gae = 0
-            for step in reversed(range(self.rewards.size(0))):
-                delta = self.rewards[step] + gamma * self.value_preds[step + 1] * self.masks[step] - self.value_preds[step]
-                gae = delta + gamma * tau * self.masks[step] * gae
-                self.returns[step] = gae + self.value_preds[step]
+            returns = gae_returns(self.rewards, self.value_preds, self.masks[:num_steps], gamma, tau)
         else:
             self.returns[-1] = next_value
-            for step in reversed(range(self.rewards.size(0))):
-                self.returns[step] = self.returns[step + 1] * \
-                    gamma * self.masks[step] + self.rewards[step]
+            returns = discounted_returns(self.rewards, self.returns[-1], self.masks[:num_steps], gamma)
+        self.returns[:-1].copy_(torch.from_numpy(returns))
 
     def last_to_first(self):
         self.obs[0].copy_(self.obs[-1])
@@ -176,16 +173,11 @@ class RolloutStoragePepper(object):
     def compute_returns(self, next_value, no_gae, gamma, tau):
         if not no_gae:
             self.value_preds[-1] = next_value
-            gae = 0
-            for step in reversed(range(self.rewards.size(0))):
-                delta = self.rewards[step] + gamma * self.value_preds[step + 1] * self.masks[step + 1] - self.value_preds[step]
-                gae = delta + gamma * tau * self.masks[step + 1] * gae
-                self.returns[step] = gae + self.value_preds[step]
+            returns = gae_returns(self.rewards, self.value_preds, self.masks[1:], gamma, tau)
         else:
             self.returns[-1] = next_value
-            for step in reversed(range(self.rewards.size(0))):
-                self.returns[step] = self.returns[step + 1] * \
-                    gamma * self.masks[step + 1] + self.rewards[step]
+            returns = discounted_returns(self.rewards, self.returns[-1], self.masks[1:], gamma)
+        self.returns[:-1].copy_(torch.from_numpy(returns))
 
     def Batch(self, advantages, mini_batch):
         '''
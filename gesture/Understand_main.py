@@ -7,10 +7,13 @@ import torch.optim as optim
 from torch.autograd import Variable
 
 from utils.arguments import get_args
+from environments.utils import env_from_args
 from utils.utils import make_log_dirs
-from utils.utils import load_dict
+from utils.utils import load_dict, load_prepared
 from data.dataset import UnderstandDataset
 from data.dataset import UnderstandDatasetCuda
+from data.dataset import UnderstandBatches
+from data.dataset import Prefetcher
 from models.understanding import VanillaCNN
 from torch.utils.data import DataLoader
 
@@ -25,11 +28,16 @@ def obstotensor(obs):
 
 def train_understand(model, Loss, opt, tloader, vloader, args, vis=None):
     min_loss = 9999
+    tloader = Prefetcher(tloader, args.prefetch)
+    vloader = Prefetcher(vloader, args.prefetch)
     for ep in range(args.epochs):
         train_loss = 0
         n = 0
+        samples = 0
+        start = time.time()
         model.train()
         for states, obs in tloader:
+            samples += states.size(0)
             opt.zero_grad()
             obs, states = Variable(obs), Variable(states, requires_grad=False)
             # if args.cuda:
@@ -42,6 +50,8 @@ def train_understand(model, Loss, opt, tloader, vloader, args, vis=None):
             opt.step()
 
         train_loss /= n
+        train_time = time.time() - start
+        train_speed = samples / train_time
         if vis:
             vis.line_update(Xdata=ep, Ydata=train_loss, name='Training Loss')
             vis.line_update(Xdata=ep, Ydata=math.log10(train_loss), name='Training LogLoss')
@@ -49,8 +59,11 @@ def train_understand(model, Loss, opt, tloader, vloader, args, vis=None):
         # Validation
         val_loss = 0
         n = 0
+        samples = 0
+        start = time.time()
         model.eval()
         for states, obs in vloader:
+            samples += states.size(0)
             obs, states = Variable(obs), Variable(states, requires_grad=False)
             # if args.cuda:
             #     obs, states = obs.cuda(), states.cuda()
@@ -59,6 +72,8 @@ def train_understand(model, Loss, opt, tloader, vloader, args, vis=None):
             val_loss += vloss.data[0]
             n += 1
         val_loss /= n
+        val_time = time.time() - start
+        val_speed = samples / val_time
 
         if val_loss < min_loss:
             min_loss = val_loss
@@ -84,13 +99,27 @@ def train_understand(model, Loss, opt, tloader, vloader, args, vis=None):
                                                           args.epochs,
                                                           train_loss,
                                                           val_loss ))
+        # a large share of time waiting for data: I/O bound, else compute bound
+        print('\t train: {:.1f} samples/sec (data wait {:.0%})\t val: {:.1f} samples/sec (data wait {:.0%})'.format(
+            train_speed, tloader.wait / train_time, val_speed, vloader.wait / val_time))
+
+
+def load_data(path, vel):
+    ''' prepared targets (data/prepare_targets.py) if there are any, else the
+    target file. vel: args.njoints, set by env_from_args.
+    Returns data and the speed columns to remove '''
+    data = load_prepared(path, njoints=vel)
+    if data is not None:
+        print('Prepared targets')
+        return data, 0
+    return load_dict(path, lazy=True), vel
 
 
 def test_understand(args):
     print('Loading training data')
-    train_data = load_dict(args.train_target_path)
+    train_data, vel = load_data(args.train_target_path, args.njoints)
     train_dset = UnderstandDatasetCuda(train_data)
-    train_dset.transform_to_cuda(vel=2)
+    train_dset.transform_to_cuda(vel=vel)
 
     st, ob = train_dset[0]
     tloader = DataLoader(train_dset, batch_size=args.batch_size, shuffle=True,  num_workers=0)
@@ -136,21 +165,33 @@ def main(args):
     # val_dset = UnderstandDataset(val_data)
     # print('Done')
 
-    # Enough room on GPU so everything is moved there at once
-    print('Loading training data')
-    train_data = load_dict(args.train_target_path)
-    train_dset = UnderstandDatasetCuda(train_data)
-    train_dset.transform_to_cuda(vel=2)
-    print('Loading validation data')
-    val_data = load_dict(args.val_target_path)
-    val_dset = UnderstandDatasetCuda(val_data)
-    val_dset.transform_to_cuda(vel=2)
-    print('Done')
-
-    # trainloader = DataLoader(train_dset, batch_size=args.batch_size, shuffle=True, pin_memory=True, num_workers=4)
-    # valloader = DataLoader(val_dset, batch_size=args.batch_size, shuffle=True, pin_memory=True, num_workers=4)
-    trainloader = DataLoader(train_dset, batch_size=args.batch_size, shuffle=True,  num_workers=0)
-    valloader = DataLoader(val_dset, batch_size=args.batch_size, shuffle=True,  num_workers=0)
+    if args.cuda:
+        # Enough room on GPU so everything is moved there at once
+        print('Loading training data')
+        train_data, vel = load_data(args.train_target_path, args.njoints)
+        train_dset = UnderstandDatasetCuda(train_data)
+        train_dset.transform_to_cuda(vel=vel)
+        print('Loading validation data')
+        val_data, vel = load_data(args.val_target_path, args.njoints)
+        val_dset = UnderstandDatasetCuda(val_data)
+        val_dset.transform_to_cuda(vel=vel)
+        print('Done')
+
+        # trainloader = DataLoader(train_dset, batch_size=args.batch_size, shuffle=True, pin_memory=True, num_workers=4)
+        # valloader = DataLoader(val_dset, batch_size=args.batch_size, shuffle=True, pin_memory=True, num_workers=4)
+        trainloader = DataLoader(train_dset, batch_size=args.batch_size, shuffle=True,  num_workers=0)
+        valloader = DataLoader(val_dset, batch_size=args.batch_size, shuffle=True,  num_workers=0)
+    else:
+        # Whole batches sliced from uint8 arrays
+        print('Loading training data')
+        train_data, vel = load_data(args.train_target_path, args.njoints)
+        train_dset = trainloader = UnderstandBatches(train_data, args.batch_size, vel=vel,
+                                                     num_workers=args.data_workers)
+        print('Loading validation data')
+        val_data, vel = load_data(args.val_target_path, args.njoints)
+        val_dset = valloader = UnderstandBatches(val_data, args.batch_size, vel=vel,
+                                                 num_workers=args.data_workers)
+        print('Done')
 
     # Check dims
     st, ob = train_dset[0]
@@ -204,8 +245,12 @@ def main(args):
         duration = time.time() - start
 
     print('Duration: ', duration)
+    if not args.cuda:
+        trainloader.close()
+        valloader.close()
 
 if __name__ == '__main__':
     args = get_args()
+    env_from_args(args)  # sets args.njoints, the speed columns of the targets
     test_understand(args)
     # main()
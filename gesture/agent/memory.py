@@ -1,8 +1,8 @@
 import torch
-from torch.utils.data.sampler import BatchSampler, SubsetRandomSampler
 from torch.utils.data import Dataset, DataLoader
 import numpy as np
 import time
+import os
 
 
 class Results(object):
@@ -195,17 +195,90 @@ class ResultsAll(object):
         vis.line_update(Xdata=frame, Ydata=std, name='Action std')
         vis.line_update(Xdata=frame, Ydata=-e, name='Entropy')
 
-class StackedObs(object):
+def hwc_to_chw(s):
+    ''' (N, H, W, C) -> (N, C, H, W) or (H, W, C) -> (C, H, W), a view '''
+    return s.transpose(0, 3, 1, 2) if s.ndim > 3 else s.transpose(2, 0, 1)
+
+
+class FrameStack(object):
+    ''' Ring buffer of the last `num_stack` frames for every process.
+
+    frames: (num_proc, num_stack, *frame_shape), `head` is the slot of the
+    newest frame. `update` writes a single slot, `check_and_reset` zeros the
+    frames of done envs only and the stack ordered oldest -> newest is only
+    materialized when it is asked for (`__call__`) and then cached.
+    '''
+    def __init__(self, num_processes, num_stack, frame_shape, use_cuda=False):
+        self.frames = torch.zeros(num_processes, num_stack, *frame_shape)
+        self.head = num_stack - 1
+        self.stacked = None
+        self.num_stack = num_stack
+        self.num_processes = num_processes
+        self.use_cuda = use_cuda
+        if use_cuda:
+            self.cuda()
+
+    def push(self, frame):
+        ''' frame: torch.Tensor (num_proc, *frame_shape), or a single frame if num_proc is 1 '''
+        self.head = (self.head + 1) % self.num_stack
+        self.frames[:, self.head].copy_(frame)
+        self.stacked = None
+
+    def check_and_reset(self, mask):
+        '''
+        :param mask     torch.Tensor, size: (num_proc, 1), and contains 1 or 0.
+        If an element is zero it means that the env for that processor is `done`
+        and thus we need to reset the state.
+        '''
+        for i in np.flatnonzero(mask.cpu().numpy() == 0):
+            self.frames[int(i)].zero_()
+            self.stacked = None
+
+    def check_and_reset_target(self, mask, new_target):
+        ''' Resets done envs and fills their whole stack with `new_target[i]` '''
+        for i in np.flatnonzero(mask.cpu().numpy() == 0):
+            self.frames[int(i)].copy_(self.to_frame(new_target[int(i)]))
+            self.stacked = None
+
+    def reset(self):
+        self.frames.zero_()
+        self.head = self.num_stack - 1
+        self.stacked = None
+
+    def stack(self):
+        ''' (num_proc, num_stack, *frame_shape) ordered oldest -> newest '''
+        if self.num_stack == 1:
+            return self.frames
+        if self.stacked is None:
+            order = [(self.head + 1 + i) % self.num_stack for i in range(self.num_stack)]
+            order = torch.LongTensor(order)
+            if self.use_cuda:
+                order = order.cuda()
+            self.stacked = self.frames.index_select(1, order)
+        return self.stacked
+
+    def cuda(self):
+        self.frames = self.frames.cuda()
+        self.stacked = None
+        self.use_cuda = True
+
+    def cpu(self):
+        self.frames = self.frames.cpu()
+        self.stacked = None
+        self.use_cuda = False
+
+
+class StackedObs(FrameStack):
     ''' stacked obs for Roboschool
 
     state: np.array, shape: (num_proc, W, H, 3) (roboschoolhumanoid)
     state: np.array, shape: (num_proc, 3, W, H) (roboschoolhumanoid)
 
     Thus with defaults:
-    current_state.size: (num_proc, 1, 3, 100, 100)
+    frames.size: (num_proc, 1, 3, 100, 100)
 
-    update: push out the oldest 1*3*100*100 numbers for all processors.
-    call:   return current_state.view(4, 1, 3, 100, 100), concat stacked states for each proc.
+    update: write the newest 1*3*100*100 numbers for all processors.
+    call:   return the stack as (num_proc, num_stack*3, 100, 100)
 
     :param state_shape      int/tuple shape
     :param num_stack        int
@@ -220,88 +293,49 @@ class StackedObs(object):
             self.obs_shape = (obs_shape[0]*num_stack, obs_shape[1], obs_shape[2])
         else:
             self.obs_shape = obs_shape
+        FrameStack.__init__(self, num_processes, num_stack, obs_shape, use_cuda)
 
-        self.num_stack = num_stack
-        self.current_state = torch.zeros(num_processes, *self.obs_shape)
-        self.num_processes = num_processes
-        self.use_cuda = use_cuda
-        if use_cuda:
-            self.cuda()
-
-    def update(self, s):
+    def to_frame(self, s):
         if type(s) is np.ndarray:
-            if len(s.shape)>3:
-                s = s.transpose(0, 3, 1, 2).astype('float')
-            else:
-                s = s.transpose(2, 0, 1).astype('float')
-            s /= 255
-            s = torch.from_numpy(s).float()
-        if self.use_cuda:
-            s = s.cuda()
-        if self.num_stack > 1:
-            self.current_state[:,:-1,:] = self.current_state[:,1:,:] # push out oldest
-            self.current_state[:,-1,:] = s  # add in newest
-        else:
-            self.current_state = s
-
-    def check_and_reset(self, mask):
-        '''
-        :param mask     torch.Tensor, size: (num_proc, 1), and contains 1 or 0.
-        If an element is zero it means that the env for that processor is `done`
-        and thus we need to reset the state.
-        '''
-        tmp = self.current_state.view(self.num_processes, -1)
-        tmp *= mask
-        self.current_state = tmp.view(self.num_processes, self.num_stack, *self.obs_shape)
+            s = torch.from_numpy(hwc_to_chw(s).astype(np.float32)).div_(255)
+        return s
 
-    def check_and_reset_target(self, mask, new_target):
+    def update(self, s):
         '''
-        :param mask     torch.Tensor, size: (num_proc, 1), and contains 1 or 0.
-        If an element is zero it means that the env for that processor is `done`
-        and thus we need to reset the state.
+        :param s    np.ndarray, pixels (num_proc, H, W, C) or (H, W, C) from the env,
+                    or torch.Tensor already (num_proc, C, H, W) in [0, 1]
         '''
-        # reset all done envs to zeros. This is if num_stack > 1.
-        tmp = self.current_state.view(self.num_processes, -1)
-        tmp *= mask
-        self.current_state = tmp.view(self.num_processes, self.num_stack, *self.obs_shape)
-        for i in range(self.current_state.size(0)):
-            if not int(mask[i]):
-                self.current_state[i] = torch.from_numpy(new_target[i])
-
-    def reset(self):
-        self.current_state = torch.zeros(self.current_state.size())
+        if type(s) is not np.ndarray:
+            self.push(s)
+            return
+        # uint8 -> float32 NCHW written straight into the ring buffer slot
+        self.head = (self.head + 1) % self.num_stack
+        self.stacked = None
+        slot = self.frames[:, self.head]
         if self.use_cuda:
-            self.cuda()
-
-    def reset_to(self):
-        self.current_state.copy_(state)
+            slot.copy_(torch.from_numpy(hwc_to_chw(s)).cuda())  # upload pixels, convert on the gpu
+        else:
+            slot.numpy()[...] = hwc_to_chw(s)
+        slot.div_(255)  # float32 x/255 equals the float64 division rounded to float32
 
     def __call__(self):
-        ''' Returns the flatten state (num_processes, -1)'''
-        return self.current_state.view(self.num_processes, *self.obs_shape)
+        ''' Returns the stacked obs (num_processes, num_stack*C, H, W)'''
+        return self.stack().view(self.num_processes, *self.obs_shape)
 
     def size(self):
         ''' Returns torch.Size '''
-        return self.current_state.view(self.num_processes, *self.obs_shape).size()
-
-    def cuda(self):
-        self.current_state = self.current_state.cuda()
-        self.use_cuda = True
-
-    def cpu(self):
-        self.state = self.state.cpu()
-        self.use_cuda = False
+        return torch.Size((self.num_processes, *self.obs_shape))
 
 
-class StackedState(object):
+class StackedState(FrameStack):
     ''' stacked state for Roboschool
     state: np.array, shape: (num_proc, 44) (roboschoolhumanoid)
 
     Thus with defaults:
-    current_state.size: (num_proc, 4, 44)
+    frames.size: (num_proc, 4, 44)
 
-    update: push out the oldest 44 numbers for all procs.
-    call:   return current_state.view(4,-1), concat stacked states for each proc.
+    update: write the newest 44 numbers for all procs.
+    call:   return the stack as (num_proc, 4*44), oldest first.
 
     :param state_shape      int/tuple shape
     :param num_stack        int
@@ -309,78 +343,26 @@ class StackedState(object):
     :param use_cuda         bool
     '''
     def __init__(self, num_processes=4, num_stack=4, state_shape=44, use_cuda=False):
-        if type(state_shape) is tuple:
-            self.current_state = torch.zeros(num_processes, num_stack, *state_shape)
-        else:
-            self.current_state = torch.zeros(num_processes, num_stack, state_shape)
-
-        self.num_stack = num_stack
+        frame_shape = state_shape if type(state_shape) is tuple else (state_shape,)
         self.state_shape = state_shape * num_stack
-        self.num_processes = num_processes
-        self.use_cuda = use_cuda
-        if use_cuda:
-            self.cuda()
+        FrameStack.__init__(self, num_processes, num_stack, frame_shape, use_cuda)
 
-    def update(self, s):
+    def to_frame(self, s):
         if type(s) is np.ndarray:
             s = torch.from_numpy(s).float()
-        assert type(s) is torch.Tensor
-        if self.use_cuda:
-            s = s.cuda()
-        if self.num_stack > 1:
-            self.current_state[:,:-1,:] = self.current_state[:,1:,:] # push out oldest
-            self.current_state[:,-1,:] = s  # add in newest
-        else:
-            self.current_state = s
+        assert torch.is_tensor(s)
+        return s
 
-    def check_and_reset(self, mask):
-        '''
-        :param mask     torch.Tensor, size: (num_proc, 1), and contains 1 or 0.
-
-        If an element is zero it means that the env for that processor is `done`
-        and thus we need to reset the state.
-        '''
-        tmp = self.current_state.view(self.num_processes, -1)
-        tmp *= mask
-        self.current_state = tmp.view(self.num_processes, self.num_stack, -1)
-
-    def check_and_reset_target(self, mask, new_target):
-        '''
-        :param mask     torch.Tensor, size: (num_proc, 1), and contains 1 or 0.
-        If an element is zero it means that the env for that processor is `done`
-        and thus we need to reset the state.
-        '''
-        # reset all done envs to zeros. This is if num_stack > 1.
-        tmp = self.current_state.view(self.num_processes, -1)
-        tmp *= mask
-        self.current_state = tmp.view(self.num_processes, self.num_stack, -1)
-        for i in range(self.current_state.size(0)):
-            if not int(mask[i]):
-                self.current_state[i] = torch.from_numpy(new_target[i])
-
-    def reset(self):
-        self.current_state = torch.zeros(self.current_state.size())
-        if self.use_cuda:
-            self.cuda()
-
-    def reset_to(self):
-        self.current_state.copy_(state)
+    def update(self, s):
+        self.push(self.to_frame(s))
 
     def __call__(self):
         ''' Returns the flatten state (num_processes, -1)'''
-        return self.current_state.view(self.num_processes, -1)
+        return self.stack().contiguous().view(self.num_processes, -1)
 
     def size(self):
         ''' Returns torch.Size '''
-        return self.current_state.view(self.num_processes, -1).size()
-
-    def cuda(self):
-        self.current_state = self.current_state.cuda()
-        self.use_cuda = True
-
-    def cpu(self):
-        self.state = self.state.cpu()
-        self.use_cuda = False
+        return self.frames.view(self.num_processes, -1).size()
 
 
 class Current(object):
@@ -405,23 +387,47 @@ class Current(object):
         self.ac_shape = ac_shape
 
         self.targets = []
+        self.target_version = None
+        self.target_index = None       # dataset index of the observed targets
+        self.next_target_index = None  # indices of targets set but not yet observed
+        self.num_stack = num_stack
         self.use_cuda = False
 
-    def update(self, state=None, s_target=None, obs=None, o_target=None):
+    def update(self, state=None, s_target=None, obs=None, o_target=None, target_version=None):
+        '''
+        :param target_version   np.ndarray, (num_proc,) from the vector env.
+        If the versions are the same as last update the cached target tensors are reused.
+        '''
         if state is not None:
             self.state.update(state)
-        if s_target is not None:
-            self.target_state.update(s_target)
         if obs is not None:
             self.obs.update(obs)
+        if target_version is not None and self.num_stack == 1:
+            if self.target_version is not None and (self.target_version == target_version).all():
+                return
+            self.target_version = np.array(target_version)
+        if s_target is not None:
+            self.target_state.update(s_target)
         if o_target is not None:
             self.target_obs.update(o_target)
 
+    def set_target_index(self, index):
+        ''' Call with `targets.indices` after `env.set_target(targets())` '''
+        self.next_target_index = np.array(index).reshape(-1)
+
+    def apply_target_index(self):
+        ''' Call after env.step/reset: targets set before it are now observed '''
+        if self.next_target_index is not None:
+            self.target_index = self.next_target_index
+            self.next_target_index = None
+
     def check_and_reset(self, mask):
         self.state.check_and_reset(mask)
         self.obs.check_and_reset(mask)
-        self.target_state.check_and_reset(mask)
-        self.target_obs.check_and_reset(mask)
+        if self.num_stack > 1:
+            # a single target frame is replaced on update anyway
+            self.target_state.check_and_reset(mask)
+            self.target_obs.check_and_reset(mask)
 
     def __call__(self):
         return self.state(), self.target_state(), self.obs(), self.target_obs()
@@ -449,6 +455,46 @@ class Current(object):
         self.use_cuda = False
 
 
+def gae_returns(rewards, value_preds, masks, gamma, tau):
+    '''
+    GAE returns, bit for bit the same as the step by step torch loop:
+
+        delta = rewards[t] + gamma * value_preds[t+1] * masks[t] - value_preds[t]
+        gae = delta + gamma * tau * masks[t] * gae
+        returns[t] = gae + value_preds[t]
+
+    Everything but the `gae` recursion is computed for all steps at once and
+    the recursion runs on small float32 numpy rows (same operations, same order).
+
+    :param rewards        torch.Tensor (num_steps, num_proc, 1)
+    :param value_preds    torch.Tensor (num_steps+1, num_proc, 1), last is the next value
+    :param masks          torch.Tensor (num_steps, num_proc, 1), mask after step t
+    :returns              np.ndarray (num_steps, num_proc, 1)
+    '''
+    r = rewards.cpu().numpy()
+    v = value_preds.cpu().numpy()
+    m = masks.cpu().numpy()
+    delta = r + np.float32(gamma) * v[1:] * m - v[:-1]
+    coef = np.float32(gamma * tau) * m
+    gae = np.zeros_like(r)
+    last = np.zeros_like(r[0])
+    for step in reversed(range(len(r))):
+        last = gae[step] = delta[step] + coef[step] * last
+    return gae + v[:-1]
+
+
+def discounted_returns(rewards, next_return, masks, gamma):
+    ''' returns[t] = returns[t+1] * gamma * masks[t] + rewards[t], same as the torch loop '''
+    r = rewards.cpu().numpy()
+    m = masks.cpu().numpy()
+    gamma = np.float32(gamma)
+    returns = np.zeros_like(r)
+    last = next_return.cpu().numpy()
+    for step in reversed(range(len(r))):
+        last = returns[step] = last * gamma * m[step] + r[step]
+    return returns
+
+
 class RolloutStorage(object):
     ''' Usage Description
     First manually make the first state be the reset state
@@ -470,15 +516,37 @@ class RolloutStorage(object):
 
     states and values has one extra data point for `next value` when computing
     returns.
+
+    uint8_obs: bool, store observations and target observations as raw
+    pixels (uint8, 1/4 of the memory). Only the minibatches yielded by
+    `Batch` and `get_last_obs` are converted back to float in [0, 1].
+
+    target_obs: torch.ByteTensor (N, C, H, W), all target observations
+    (`Targets.obs_tensor()`). If given only the index of the target is
+    stored for every step (`insert(..., target_index)`) and the target
+    observations are gathered from it in `Batch`. Requires num_stack 1.
+    The table stays on the cpu, `cuda()` only moves the gathered rows.
     '''
     def __init__(self, num_steps,
                  num_processes,
                  stacked_s_shape,
                  stacked_st_shape,
                  stacked_o_shape,
-                 action_shape):
+                 action_shape,
+                 uint8_obs=False,
+                 target_obs=None):
         self.observations        = torch.zeros(num_steps+1, num_processes, *stacked_o_shape)
-        self.target_observations = torch.zeros(num_steps+1, num_processes, *stacked_o_shape)
+        if target_obs is None:
+            self.target_observations = torch.zeros(num_steps+1, num_processes, *stacked_o_shape)
+        else:
+            assert target_obs.size()[1:] == torch.Size(stacked_o_shape), 'target index storage requires num_stack 1'
+            self.target_observations = None
+            self.target_index        = torch.zeros(num_steps+1, num_processes).long()
+        if uint8_obs:
+            self.observations = self.observations.byte()
+            if target_obs is None:
+                self.target_observations = self.target_observations.byte()
+        self.target_obs          = target_obs
         self.states              = torch.zeros(num_steps+1, num_processes, stacked_s_shape)
         self.target_states       = torch.zeros(num_steps+1, num_processes, stacked_st_shape)
         self.value_preds         = torch.zeros(num_steps+1, num_processes, 1)
@@ -490,10 +558,15 @@ class RolloutStorage(object):
         self.num_processes       = num_processes
         self.num_steps           = num_steps
         self.obs_size            = stacked_o_shape
+        self.uint8_obs           = uint8_obs
+        self.use_cuda            = False
 
     def cuda(self):
         self.observations        = self.observations.cuda()
-        self.target_observations = self.target_observations.cuda()
+        if self.target_obs is None:
+            self.target_observations = self.target_observations.cuda()
+        else:
+            self.target_index    = self.target_index.cuda()
         self.states              = self.states.cuda()
         self.target_states       = self.target_states.cuda()
         self.rewards             = self.rewards.cuda()
@@ -502,11 +575,42 @@ class RolloutStorage(object):
         self.actions             = self.actions.cuda()
         self.masks               = self.masks.cuda()
         self.action_log_probs    = self.action_log_probs.cuda()
+        self.use_cuda            = True
+
+    def to_storage(self, obs):
+        ''' float obs in [0, 1] -> stored dtype '''
+        if self.uint8_obs:
+            return obs.mul(255).round_()
+        return obs
+
+    def from_storage(self, obs):
+        ''' stored obs -> float in [0, 1] '''
+        if self.uint8_obs:
+            return self.pixels_to_float(obs)
+        return obs
+
+    def pixels_to_float(self, pixels):
+        ''' same values as StackedObs.update computes '''
+        return pixels.float().div_(255)
+
+    def gather_target_obs(self, index):
+        ''' float target observations of `index`, only these rows are moved to the gpu '''
+        target_obs = self.target_obs.index_select(0, index.cpu())
+        if self.use_cuda:
+            target_obs = target_obs.cuda()
+        return self.pixels_to_float(target_obs)
 
-    def insert(self, step, state, target_state, obs, target_obs, action, action_log_prob, value_pred, reward, mask):
-        self.target_observations[step + 1].copy_(target_obs)
+    def insert_target_obs(self, step, target_obs, target_index):
+        if self.target_obs is None:
+            self.target_observations[step].copy_(self.to_storage(target_obs))
+        else:
+            self.target_index[step].copy_(torch.from_numpy(np.asarray(target_index)))
+
+    def insert(self, step, state, target_state, obs, target_obs, action, action_log_prob, value_pred, reward, mask,
+               target_index=None):
+        self.insert_target_obs(step + 1, target_obs, target_index)
         self.target_states[step + 1].copy_(target_state)
-        self.observations[step + 1].copy_(obs)
+        self.observations[step + 1].copy_(self.to_storage(obs))
         self.states[step + 1].copy_(state)
         self.masks[step + 1].copy_(mask)
         self.actions[step].copy_(action)
@@ -515,21 +619,24 @@ class RolloutStorage(object):
         self.rewards[step].copy_(reward)
 
     def last_to_first(self):
-        self.target_observations[0].copy_(self.target_observations[-1])
+        if self.target_obs is None:
+            self.target_observations[0].copy_(self.target_observations[-1])
+        else:
+            self.target_index[0].copy_(self.target_index[-1])
         self.observations[0].copy_(self.observations[-1])
         self.target_states[0].copy_(self.target_states[-1])
         self.states[0].copy_(self.states[-1])
         self.masks[0].copy_(self.masks[-1])
 
-    def first_insert(self, state=None, s_target=None, o=None, ot=None):
+    def first_insert(self, state=None, s_target=None, o=None, ot=None, target_index=None):
         if state is not None:
             self.states[0].copy_(state)
         if s_target is not None:
             self.target_states[0].copy_(s_target)
         if o is not None:
-            self.observations[0].copy_(o)
-        if ot is not None:
-            self.target_observations[0].copy_(ot)
+            self.observations[0].copy_(self.to_storage(o))
+        if ot is not None or target_index is not None:
+            self.insert_target_obs(0, ot, target_index)
 
     def get_last(self):
         o, o_target = self.get_last_obs()
@@ -551,22 +658,36 @@ class RolloutStorage(object):
         use `view(num_proc, -1)` to get correct dims for policy.
         '''
         o = self.observations[-1].view(-1, *self.obs_size)
-        target_o = self.target_observations[-1].view(-1, *self.obs_size)
-        return o, target_o
+        if self.target_obs is None:
+            target_o = self.from_storage(self.target_observations[-1].view(-1, *self.obs_size))
+        else:
+            target_o = self.gather_target_obs(self.target_index[-1])
+        return self.from_storage(o), target_o
 
     def compute_returns(self, next_value, no_gae, gamma, tau):
         if not no_gae:
             self.value_preds[-1] = next_value
-            gae = 0
-            for step in reversed(range(self.rewards.size(0))):
-                delta = self.rewards[step] + gamma * self.value_preds[step + 1] * self.masks[step + 1] - self.value_preds[step]
-                gae = delta + gamma * tau * self.masks[step + 1] * gae
-                self.returns[step] = gae + self.value_preds[step]
+            returns = gae_returns(self.rewards, self.value_preds, self.masks[1:], gamma, tau)
         else:
             self.returns[-1] = next_value
-            for step in reversed(range(self.rewards.size(0))):
-                self.returns[step] = self.returns[step + 1] * \
-                    gamma * self.masks[step + 1] + self.rewards[step]
+            returns = discounted_returns(self.rewards, self.returns[-1], self.masks[1:], gamma)
+        self.returns[:-1].copy_(torch.from_numpy(returns))
+
+    def flat_fields(self, advantages):
+        ''' All fields as (num_steps*num_processes, ...) views, the order yielded by Batch '''
+        if self.target_obs is None:
+            target_obs = self.target_observations[:-1].view(-1, *self.obs_size)
+        else:
+            target_obs = self.target_index[:-1].contiguous().view(-1)
+        return [self.states[:-1].view(-1, self.states.size(-1)),
+                self.target_states[:-1].view(-1, self.target_states.size(-1)),
+                self.observations[:-1].view(-1, *self.obs_size),
+                target_obs,
+                self.actions.view(-1, self.actions.size(-1)),
+                self.returns[:-1].view(-1, 1),
+                self.masks[:-1].view(-1, 1),
+                self.action_log_probs.view(-1, 1),
+                advantages.contiguous().view(-1, 1)]
 
     def Batch(self, advantages, mini_batch):
         '''
@@ -575,34 +696,32 @@ class RolloutStorage(object):
         Reshape into correct shape such that everything migth be passed through a network
         in one forward pass.
 
+        The fields are flattened once and every minibatch is a slice of one
+        random permutation, gathered with a single `index_select` per field.
+
         :param advantages       torch.Tensor
         :param mini_batch       int, size of batch (64, 128 etc)
         '''
         data_size = self.num_processes * self.num_steps  # total data size is steps*processsors
+        fields = self.flat_fields(advantages)
 
         # Choose `mini_batch` indices from total `data_size`.
         # Choose `64` indices from total `2048`.
-        sampler = BatchSampler(SubsetRandomSampler(range(data_size)),
-                               mini_batch, drop_last=False)
-
-        for indices in sampler:
-            indices = torch.LongTensor(indices)
-
-            if advantages.is_cuda:
-                indices = indices.cuda()
-
-            # all but last entry
-            obs_batch    = self.observations[:-1].view(-1, *self.obs_size)[indices]
-            target_obs_batch    = self.target_observations[:-1].view(-1, *self.obs_size)[indices]
-            states_batch = self.states[:-1].view(-1, self.states.size(-1))[indices]
-            target_states_batch = self.target_states[:-1].view(-1, self.target_states.size(-1))[indices]
-            return_batch = self.returns[:-1].view(-1, 1)[indices]
-            masks_batch  = self.masks[:-1].view(-1, 1)[indices]
-
-            # all entries
-            actions_batch              = self.actions.view(-1, self.actions.size(-1))[indices]
-            old_action_log_probs_batch = self.action_log_probs.view(-1, 1)[indices]
-            adv_targ = advantages.view(-1, 1)[indices]
+        permutation = torch.randperm(data_size)
+        if advantages.is_cuda:
+            permutation = permutation.cuda()
+
+        for start in range(0, data_size, mini_batch):
+            indices = permutation[start:start + mini_batch]
+            states_batch, target_states_batch, obs_batch, target_obs_batch, \
+                actions_batch, return_batch, masks_batch, \
+                old_action_log_probs_batch, adv_targ = [f.index_select(0, indices) for f in fields]
+
+            obs_batch = self.from_storage(obs_batch)
+            if self.target_obs is None:
+                target_obs_batch = self.from_storage(target_obs_batch)
+            else:
+                target_obs_batch = self.gather_target_obs(target_obs_batch)
             yield states_batch, target_states_batch, obs_batch, \
                 target_obs_batch, actions_batch, return_batch, \
                 masks_batch, old_action_log_probs_batch, adv_targ
@@ -610,39 +729,134 @@ class RolloutStorage(object):
 
 class Targets(object):
     """ Targets
-    1. Holds the state and obs targets
+    1. Holds the state and obs targets as (N, ...) arrays
     2. returns a self.n-sized list (num proc) with random targets
+
+    datadict values are lists of arrays (stacked here) or array like datasets
+    (`load_dict(..., lazy=True)`), rows are only read when they are used.
     """
     def __init__(self, n, datadict):
         self.n = n
-        self.states = datadict['states']
-        self.obs = datadict['obs']
+        self.states = as_array(datadict['states'])
+        self.obs = as_array(datadict['obs'])
+        self.indices = None  # dataset indices of the last targets returned by __call__
+        self.loader = None  # TargetLoader this set was opened with, if any
 
     def remove_speed(self, njoints):
-        for i, s in enumerate(self.states):
-            self.states[i] = s[:-njoints]
+        ''' drops the last njoints (speed) columns, states become float32 '''
+        self.states = np.asarray(self.states[:, :-njoints], dtype=np.float32)
         print('Removed speed')
 
     def random_target(self):
         idx = np.random.randint(0,len(self.states))
-        return [self.states[idx], self.obs[idx]]
+        return self[idx]
 
     def __len__(self):
         return len(self.states)
 
+    def rows(self, idx):
+        ''' states (n, ...) and obs (n, H, W, C) of the dataset indices `idx` '''
+        return take(self.states, idx), take(self.obs, idx)
+
+    def sample(self, n=None):
+        ''' n (default: self.n) random targets, returns indices, states, obs '''
+        idx = np.random.randint(0, len(self.states), n or self.n)
+        self.indices = idx
+        return (idx,) + self.rows(idx)
+
     def __call__(self):
+        idx, states, obs = self.sample()
         if self.n > 1:
-            idx = np.random.randint(0,len(self.states), self.n)
-            ret = []
-            for ix in idx:
-                ret.append([self.states[ix], self.obs[ix]])
-            return ret
-        else:
-            idx = np.random.randint(0,len(self.states))
-            return [self.states[idx], self.obs[idx]]
+            return TargetBatch(idx, states, obs)
+        return [states[0], obs[0]]
+
+    def obs_tensor(self):
+        ''' All target observations as one torch.ByteTensor (N, C, H, W) '''
+        obs = np.asarray(self.obs[:])
+        return torch.from_numpy(np.array(obs.transpose(0, 3, 1, 2), order='C'))
 
     def __getitem__(self, idx):
-        return [self.states[idx], self.obs[idx]]
+        ''' contiguous, writable copies (prepared obs are transposed, read only views) '''
+        idx = int(idx)
+        return [np.array(self.states[idx], order='C'), np.array(self.obs[idx], order='C')]
+
+
+class TargetBatch(list):
+    ''' [[state, obs], ...] as returned by `Targets.__call__`, with the same
+    targets as stacked arrays `states`, `obs` and their dataset `indices` '''
+    def __init__(self, indices, states, obs):
+        super().__init__([s, o] for s, o in zip(states, obs))
+        self.indices = indices
+        self.states = states
+        self.obs = obs
+
+
+class TargetLoader(object):
+    ''' Opens a target file as Targets. Picklable, so worker processes can
+    open their own (memory mapped) copy of the set, see
+    `SubprocVecEnv_Social.load_targets`.
+
+    Opens the prepared cache of the file if there is one (see
+    data/prepare_targets.py). Otherwise the states without speed are cached
+    next to the target file (`{name}_nospeed{njoints}.npy`) and memory
+    mapped by later runs.
+
+    :param path         string, h5py target file
+    :param njoints      int, speed columns to remove (None: keep)
+    '''
+    def __init__(self, path, njoints=None):
+        self.path = path
+        self.njoints = njoints
+
+    def __call__(self, n=1):
+        from gesture.utils.utils import load_dict, load_prepared
+        prepared = load_prepared(self.path, self.njoints)
+        if prepared is not None:
+            targets = Targets(n, prepared)
+            targets.loader = self
+            return targets
+        targets = Targets(n, load_dict(self.path, lazy=True))
+        if self.njoints:
+            cache = '{}_nospeed{}.npy'.format(os.path.splitext(self.path)[0], self.njoints)
+            if is_newer(cache, self.path):
+                targets.states = np.load(cache, mmap_mode='r')
+                print('Removed speed (cached)')
+            else:
+                targets.remove_speed(self.njoints)
+                save_array(cache, targets.states)
+        targets.loader = self
+        return targets
+
+
+def is_newer(filename, source):
+    return os.path.exists(filename) and os.path.getmtime(filename) >= os.path.getmtime(source)
+
+
+def save_array(filename, array):
+    ''' np.save through a temporary file, skipped if the directory is read only '''
+    tmp = '{}.{}.tmp'.format(filename, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp, filename)
+    except OSError as e:
+        print('Could not cache {}: {}'.format(filename, e))
+
+
+def as_array(data):
+    ''' lists are stacked, arrays and h5py datasets are kept as they are '''
+    if isinstance(data, list):
+        return np.stack(data)
+    return data
+
+
+def take(data, idx):
+    ''' data[idx] in one read as a contiguous array,
+    h5py datasets only take sorted unique indices '''
+    if isinstance(data, np.ndarray):
+        return np.ascontiguousarray(data[idx])
+    unique, inverse = np.unique(idx, return_inverse=True)
+    return np.ascontiguousarray(data[unique][inverse])
 
 # Test functions
 def obs_process(obs):
@@ -26,37 +26,81 @@ def exploration(pi, current, targets, rollouts, args, result,  env):
         cpu_actions = action.data.squeeze(1).cpu().numpy()
 
         # Observe reward and next state
-        state, s_target, obs, o_target, reward, done, info = env.step(cpu_actions)
-        reward = torch.from_numpy(reward).view(args.num_proc, -1).float()
-        masks = torch.FloatTensor([[0.0] if done_ else [1.0] for done_ in done])
-        result.episode_rewards += reward
-
-        if args.render:
-            env.render()
-
-        if sum(done) > 0:
-            # Clear episode reward and update final rewards
-            result.tmp_final_rewards *= masks
-            result.tmp_final_rewards += (1 - masks) * result.episode_rewards
-            result.episode_rewards *= masks
-            result.update_list()
-
-            env.set_target(targets())
+        s, st, o, ot = observe(step, env.step(cpu_actions),
+                               value.data, action.data, action_log_prob.data,
+                               current, targets, rollouts, args, result, env)
+
+def exploration_async(pi, current, targets, rollouts, args, result,  env):
+    ''' Double buffered exploration:
+    Same as `exploration` but the envs are split in two halves. The actions
+    for the second half are sampled while the first half simulates
+    (`env.step_async` / `env.step_wait`).
+    '''
+    # split on worker boundaries (envs_per_worker)
+    half = max(1, len(env.worker_envs) // 2)
+    halves = [sum(env.worker_envs[:half], []), sum(env.worker_envs[half:], [])]
+    halves = [idx for idx in halves if idx]
+    s, st, o, ot = current()
+    for step in range(args.num_steps):
+        # add step count
+        pi.n += 1
 
-        if args.cuda:
-            masks = masks.cuda()
+        # Sample actions for one half while the other half simulates
+        samples = []
+        for idx in halves:
+            ix = torch.LongTensor(idx)
+            if args.cuda:
+                ix = ix.cuda()
+            value, action, action_log_prob, a_std = pi.sample(s[ix], st[ix], o[ix], ot[ix])
+            env.step_async(action.data.squeeze(1).cpu().numpy(), idx)
+            samples.append((value.data, action.data, action_log_prob.data))
+        value, action, action_log_prob = [torch.cat(x) for x in zip(*samples)]
 
-        # Reset current states for envs done and
-        # update current state and add data to rollouts
-        current.check_and_reset(masks)
-        current.update(state, s_target, obs, o_target)
-        s, st, o, ot = current()
-        rollouts.insert(step, s, st, o, ot,
-                        action.data,
-                        action_log_prob.data,
-                        value.data,
-                        reward,
-                        masks)
+        # Observe reward and next state
+        s, st, o, ot = observe(step, env.step_wait(),
+                               value, action, action_log_prob,
+                               current, targets, rollouts, args, result, env)
+
+def observe(step, step_result, value, action, action_log_prob, current, targets, rollouts, args, result, env):
+    ''' Bookkeeping after an env step, shared by `exploration` and `exploration_async`:
+    rewards and masks, new targets for done envs, update `current` and
+    insert the step into `rollouts`. Returns the new `current()`.
+    '''
+    state, s_target, obs, o_target, reward, done, info = step_result
+    current.apply_target_index()
+    reward = torch.from_numpy(reward).view(args.num_proc, -1).float()
+    masks = torch.FloatTensor([[0.0] if done_ else [1.0] for done_ in done])
+    result.episode_rewards += reward
+
+    if args.render:
+        env.render()
+
+    if sum(done) > 0:
+        # Clear episode reward and update final rewards
+        result.tmp_final_rewards *= masks
+        result.tmp_final_rewards += (1 - masks) * result.episode_rewards
+        result.episode_rewards *= masks
+        result.update_list()
+
+        env.set_target(targets())
+        current.set_target_index(targets.indices)
+
+    if args.cuda:
+        masks = masks.cuda()
+
+    # Reset current states for envs done and
+    # update current state and add data to rollouts
+    current.check_and_reset(masks)
+    current.update(state, s_target, obs, o_target, env.target_version)
+    s, st, o, ot = current()
+    rollouts.insert(step, s, st, o, ot,
+                    action,
+                    action_log_prob,
+                    value,
+                    reward,
+                    masks,
+                    current.target_index)
+    return s, st, o, ot
 
 def train(pi, args, rollouts, optimizer_pi):
     last_value, _, _, _ = pi.sample(*rollouts.get_last())
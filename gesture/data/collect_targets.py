@@ -9,19 +9,31 @@ Bash:
 
 Saves 100000 state and observations using 4 processors to:
 
-    /FILE/PATH/{}_S{s_shape}_O{Color}-{Width}-{Height}_n{DATAPOINTS}_{RUN}.pt
+    /FILE/PATH/{}_S{s_shape}_O{Color}-{Width}-{Height}_n{DATAPOINTS}_{RUN}.h5
+
+Every processor writes its own shard file, the shards are merged into one
+dataset at the end. Frames are streamed to disk in chunks of --chunk-size
+rows. The merged file is contiguous and memory mapped by
+load_dict(..., lazy=True) unless it is compressed with --compression
+(gzip or lz4: smaller files, slower random reads).
+
+Shards are written in segments of --flush-interval frames, a .json manifest
+per shard lists the committed segments. An interrupted run is continued by
+running the same command with --resume.
 
 '''
 from gesture.utils.arguments import get_args
-from gesture.utils.utils import save_dict, load_dict
+from gesture.utils.utils import DictWriter
 from gesture.environments.utils import env_from_args
-from gesture.environments.social import Social_multiple
 
+from multiprocessing import Process, Value
 from tqdm import tqdm
 import numpy as np
+import h5py
+import json
 import os
+import time
 import pathlib
-from torch import save
 
 def get_filename(path='/tmp', s_shape=6, o_shape=(40,40,3), n=10000, args=None):
     ''' returns string:
@@ -36,48 +48,152 @@ def get_filename(path='/tmp', s_shape=6, o_shape=(40,40,3), n=10000, args=None):
         run += 1
     return os.path.join("{}_{}.h5".format(filename, run))
 
-def collect_random_targets(Env, args):
-    """ Runs episodes and saves rgb, state pairs
-    :dpoints            : Number of data points to collect
-    :Returns            : dict
+def get_writer(filename, args, n=None):
+    return DictWriter(filename,
+                      chunk_size=args.chunk_size,
+                      compression=args.compression,
+                      shuffle=not args.no_shuffle,
+                      n=n)
+
+def shard_names(args):
+    ''' one shard per worker, named by the run so they can be found again '''
+    pathlib.Path(args.filepath).mkdir(parents=True, exist_ok=True)
+    name = '{}_n{}_p{}_seed{}_shard{}'
+    return [os.path.join(args.filepath, name.format(args.env_id, args.dpoints, args.num_proc, args.seed, rank))
+            for rank in range(args.num_proc)]
+
+def read_manifest(shard):
+    with open(shard + '.json') as f:
+        return json.load(f)
+
+def start_manifest(shard, n, args):
+    ''' committed segments of a shard, an empty manifest unless resuming '''
+    if not args.resume or not os.path.exists(shard + '.json'):
+        return {'frames': 0, 'segments': [], 'n': n, 'flush_interval': args.flush_interval}
+    manifest = read_manifest(shard)
+    if manifest['n'] != n or manifest['flush_interval'] != args.flush_interval:
+        raise ValueError('{} was collected with other settings: {}'.format(shard, manifest))
+    return manifest
+
+def write_manifest(shard, manifest):
+    ''' atomic: written to a temporary file that replaces the old manifest '''
+    tmp = shard + '.json.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, shard + '.json')
+
+def fsync(filename):
+    with open(filename, 'rb') as f:
+        os.fsync(f.fileno())
+
+def segment_seed(seed, rank, segment):
+    ''' every segment (--flush-interval frames) of every shard has its own seed '''
+    return int(np.random.RandomState([seed, rank, segment]).randint(2**31 - 1))
+
+def collect_shard(Env, args, shard, rank, n, counter):
+    """ Worker: runs random episodes and writes n rgb, state pairs to its own files
+    A shard is written in segments of args.flush_interval frames, one file
+    each. A finished segment is committed to the shard manifest, a crash only
+    loses the segment being written. Every segment starts from its own seed
+    and a reset, so a resumed shard continues exactly as the interrupted one
+    would have.
+    :counter            : multiprocessing.Value, frames written by all workers
     """
-    states, obs_list = [], []
-    if args.num_proc > 1:
-        print('Collecting {} datapoints using {} processes'.format(args.dpoints, args.num_proc))
-        env = Social_multiple(Env, args)
-        s_shape = env.state_space.shape
-        o_shape = env.observation_space.shape
-        dummy_target = [[np.array(s_shape), np.array(s_shape)]] *args.num_proc # Dummy target
-        env.set_target(dummy_target)
-
-        steps = args.dpoints // args.num_proc
-        print('Collecting {} data points'.format(args.dpoints))
-        s, st, o, ot = env.reset()
-        for i in tqdm(range(steps)):
-            action = np.random.rand(*(args.num_proc, *env.action_space.shape)) * 2 -1 # [0 1] -> [-1 1]
-            s, _, o, _, r, d, _ = env.step(action)
-            for j in range(args.num_proc):
-                states.append(s[j])
-                obs_list.append(o[j])
-    else:
-        print('Collecting', args.dpoints,'datapoints using a single processes')
-        env = Env(args)
-        env.seed(np.random.randint(0, 10000))
-        s_shape = env.state_space.shape[0]
-        o_shape = env.observation_space.shape
-        env.set_target([np.array(s_shape), np.array(s_shape)]) # Dummy target
-
-        steps = args.dpoints
+    manifest = start_manifest(shard, n, args)
+    if manifest['frames'] == n:
+        return
+    env = Env(args)
+    s_shape = env.state_space.shape[0]
+    env.set_target([np.array(s_shape), np.array(s_shape)]) # Dummy target
+
+    for first in range(manifest['frames'], n, args.flush_interval):
+        segment = first // args.flush_interval
+        seed = segment_seed(args.seed, rank, segment)
+        np.random.seed(seed)
+        env.seed(seed)
+        filename = '{}_{:05d}.h5'.format(shard, segment)
+        writer = get_writer(filename, args)
         s, st, o, ot = env.reset()
-        for i in tqdm(range(steps)):
-            states.append(s)
-            obs_list.append(o)
-
-            action = env.action_space.sample()
-            s, _, o, _, r, d, _ = env.step(action)
+        last = min(first + args.flush_interval, n)
+        for i in range(last - first):
+            if i % args.chunk_size == 0:
+                actions = np.random.rand(args.chunk_size, *env.action_space.shape) * 2 -1 # [0 1] -> [-1 1]
+            writer.append({'states': s, 'obs': o})
+            s, _, o, _, r, d, _ = env.step(actions[i % args.chunk_size])
             if d:
                 s, _, o, _ = env.reset()
-    return {'obs':obs_list, 'states': states}, s_shape, o_shape
+            if (i+1) % args.chunk_size == 0 or first+i+1 == last:
+                with counter.get_lock():
+                    counter.value += (i % args.chunk_size) + 1
+        writer.close()
+        fsync(filename)
+        manifest['frames'] = last
+        manifest['segments'].append(filename)
+        write_manifest(shard, manifest)
+
+def merge_shards(shards, filename, args):
+    ''' Concatenates the segments of all shards, in order, into one dataset
+    and removes them. Row offsets of the shards are stored in the file
+    attribute `shard_offsets`.
+    '''
+    offsets = [0]
+    tmp = filename + '.tmp'
+    n = sum(shard['frames'] for shard in shards)
+    with get_writer(tmp, args, n) as writer:
+        for shard in shards:
+            for segment in shard['segments']:
+                with h5py.File(segment, 'r') as hdf:
+                    writer.extend({k: hdf[k][:] for k in hdf.keys()})
+            offsets.append(len(writer))
+        writer.hdf.attrs['shard_offsets'] = offsets
+    os.replace(tmp, filename)
+
+def collect_random_targets(Env, args):
+    """ Runs episodes and saves rgb, state pairs
+    Every process writes its own shard, the shards are merged at the end.
+    :dpoints            : Number of data points to collect
+    :Returns            : filename
+    """
+    print('Collecting {} datapoints using {} processes'.format(args.dpoints, args.num_proc))
+    shards = shard_names(args)
+    sizes = [args.dpoints // args.num_proc + (rank < args.dpoints % args.num_proc)
+             for rank in range(args.num_proc)]
+    done = sum(start_manifest(shard, n, args)['frames'] for shard, n in zip(shards, sizes))
+    if done:
+        print('Resuming from {} committed frames'.format(done))
+    counter = Value('l', done)
+    ps = [Process(target=collect_shard, args=(Env, args, shards[rank], rank, sizes[rank], counter))
+          for rank in range(args.num_proc)]
+    for p in ps:
+        p.daemon = True
+        p.start()
+
+    t0 = time.time()
+    with tqdm(total=args.dpoints, initial=done, unit='frames') as pbar:
+        while any(p.is_alive() for p in ps):
+            time.sleep(0.5)
+            pbar.update(counter.value - pbar.n)
+        pbar.update(counter.value - pbar.n)
+    for p in ps:
+        p.join()
+        if p.exitcode != 0:
+            raise RuntimeError('Collection process exited with code {}'.format(p.exitcode))
+    print('Collected {} frames, {:.1f} frames/sec'.format(counter.value, (counter.value - done) / (time.time() - t0)))
+
+    manifests = [read_manifest(shard) for shard in shards]
+    with h5py.File(manifests[0]['segments'][0], 'r') as hdf:
+        s_shape = hdf['states'].shape[1]
+        o_shape = hdf['obs'].shape[1:]
+    filename = get_filename(args.filepath, s_shape, o_shape, args.dpoints, args)
+    print('Saving dict to:\n\t', filename)
+    merge_shards(manifests, filename, args)
+    for shard, manifest in zip(shards, manifests):
+        for segment in manifest['segments']:
+            os.remove(segment)
+        os.remove(shard + '.json')
+    return filename
 
 def collect_continous(Env, args):
     '''
@@ -89,22 +205,24 @@ def collect_continous(Env, args):
     args.MAX_TIME = args.dpoints  # never reset
     print(args.MAX_TIME)
     print(args.dpoints)
-    trajectory = {'states': [], 'obs': []}  # dataset wants dict
 
     s_shape = env.state_space.shape[0]
     o_shape = env.observation_space.shape
     env.set_target([np.array(s_shape), np.array(s_shape)])  #set random targets
 
+    filename = get_filename(args.filepath, s_shape, o_shape, args.dpoints, args)
+    print('Saving dict to:\n\t', filename)
+    writer = get_writer(filename, args, args.dpoints)
     s, _, o, _ = env.reset()
     for i in tqdm(range(args.dpoints)):
-        trajectory['states'].append(s)
-        trajectory['obs'].append(o)
+        writer.append({'states': s, 'obs': o})
         # action = env.action_space.sample()
         action = np.random.rand(*env.action_space.shape) * 2 -1 # [0 1] -> [-1 1]
         s, _, o, _, r, d, _ = env.step(action)
         # if d:
         #     s, _, o, _ = env.reset()
-    return trajectory, s_shape, o_shape
+    writer.close()
+    return writer.filename
 
 
 if __name__ == '__main__':
@@ -112,10 +230,7 @@ if __name__ == '__main__':
     Env = env_from_args(args)
 
     if args.continuous_targets:
-        datadict, s_shape, o_shape = collect_continous(Env, args)
+        filename = collect_continous(Env, args)
     else:
-        datadict, s_shape, o_shape = collect_random_targets(Env, args)
-
-    filename = get_filename(args.filepath, s_shape, o_shape, args.dpoints, args)
-    print('Saving dict to:\n\t', filename)
-    save_dict(datadict, filename)
+        filename = collect_random_targets(Env, args)
+    print('Done:', filename)
@@ -1,6 +1,9 @@
 import torch
 from torch.autograd import Variable
 import numpy as np
+import queue
+import threading
+import time
 from tqdm import tqdm
 from torch.utils.data import Dataset, DataLoader
 
@@ -8,15 +11,16 @@ from torch.utils.data import Dataset, DataLoader
 class ToTensor(object):
     def __call__(self, state, obs):
         obs = obs.transpose((2, 0, 1))  #swap color axis np(seq,H,W,C) -> torch(seq,C,H,W)
-        obs = torch.from_numpy(obs).float()
+        obs = torch.from_numpy(obs.astype(np.float32))  # copy, rows may be read only views of the file
         obs /= 255.  # normalize
-        return torch.from_numpy(state).float(), obs
+        return torch.from_numpy(np.asarray(state, dtype=np.float32).copy()), obs
 
 
 class UnderstandDataset(Dataset):
     '''Dataset for Understandigng model
     Arguments:
         :data       : Dict: {'obs': [obs_list], 'states': [states]}
+                      or array like (`load_dict(..., lazy=True)`), indexed per item
     '''
     def __init__(self, data, transform=ToTensor()):
         self.obs = data['obs']
@@ -46,18 +50,216 @@ class UnderstandDatasetCuda(Dataset):
     def __len__(self):
         return len(self.obs)
 
-    def transform_to_cuda(self, vel=2):
+    def transform_to_cuda(self, vel=2, chunk=4096):
+        ''' Moves everything to the gpu as two tensors, `chunk` rows at a time
+        vel: speed columns to remove from the states (0 for prepared targets) '''
         obs_cuda, state_cuda = [], []
-        for s, obs in tqdm(zip(self.state, self.obs)):
-            obs = obs.transpose((2, 0, 1))  #swap color axis np(seq,H,W,C) -> torch(seq,C,H,W)
-            obs = torch.from_numpy(obs).float()
+        for i in tqdm(range(0, len(self.obs), chunk)):
+            obs = np.asarray(self.obs[i:i+chunk]).transpose(0, 3, 1, 2)  # uint8 (n, C, H, W)
+            obs = torch.from_numpy(np.array(obs, order='C')).cuda().float()
             obs /= 255.  # normalize
-            obs = obs.cuda()
-            s = torch.from_numpy(s[:-vel]).float().cuda()
+            s = np.asarray(self.state[i:i+chunk])
+            s = s[:, :s.shape[1]-vel].astype(np.float32)
             obs_cuda.append(obs)
-            state_cuda.append(s)
-        self.obs = obs_cuda
-        self.state = state_cuda
+            state_cuda.append(torch.from_numpy(s).cuda())
+        self.obs = torch.cat(obs_cuda)
+        self.state = torch.cat(state_cuda)
 
     def __getitem__(self, idx):
         return self.state[idx], self.obs[idx]
+
+
+class UnderstandBatches(object):
+    '''Batches for the Understanding model on the cpu, replaces Dataset + DataLoader
+    The states are held as float32 (N, S) and the obs as uint8 (N, C, H, W)
+    arrays (memory mapped for prepared targets, else read once). A batch is
+    one fancy index per array and one float conversion of all its obs.
+    Arguments:
+        :data           : Dict: {'obs', 'states'} from load_dict/load_prepared
+        :batch_size     : int
+        :vel            : int, speed columns to remove from the states
+        :shuffle        : bool
+        :num_workers    : int, processes gathering the next batches into
+                          shared memory while the current one is used
+    '''
+    def __init__(self, data, batch_size, vel=2, shuffle=True, num_workers=0):
+        self.state = contiguous_states(data['states'], vel)
+        self.obs = contiguous_obs(data['obs'])
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_workers = num_workers
+        self.obs_shape = self.obs.shape[1:]
+        self.state_shape = self.state.shape[1:]
+        self.ps = []
+
+    def __len__(self):
+        return (len(self.obs) + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, idx):
+        states, obs = self.convert(np.take(self.state, [idx], axis=0),
+                                   np.take(self.obs, [idx], axis=0))
+        return states[0], obs[0]
+
+    def convert(self, states, obs):
+        ''' numpy (n, S) float32, (n, C, H, W) uint8 -> new torch tensors '''
+        return torch.from_numpy(np.array(states)), torch.from_numpy(obs).float().div_(255)
+
+    def __iter__(self):
+        n = len(self.obs)
+        order = np.random.permutation(n) if self.shuffle else np.arange(n)
+        batches = [order[i:i+self.batch_size] for i in range(0, n, self.batch_size)]
+        if self.num_workers == 0:
+            for idx in batches:
+                yield self.convert(np.take(self.state, idx, axis=0),
+                                   np.take(self.obs, idx, axis=0))
+        else:
+            yield from self.prefetch(batches)
+
+    def prefetch(self, batches):
+        ''' Batch k is gathered by a worker in slot k % slots, ahead of time '''
+        if not self.ps:
+            self.start_workers()
+        nslots = len(self.slots)
+        for k, idx in enumerate(batches[:nslots]):
+            self.tasks.put((k, idx))
+        ready, sent, k = set(), min(nslots, len(batches)), -1
+        try:
+            for k, idx in enumerate(batches):
+                while k not in ready:
+                    ready.add(self.done.get())
+                ready.remove(k)
+                states, obs = self.slots[k % nslots]
+                batch = self.convert(states.array[:len(idx)], obs.array[:len(idx)])
+                if sent < len(batches):
+                    self.tasks.put((sent, batches[sent]))
+                    sent += 1
+                yield batch
+        finally:
+            # stopped early: let the workers finish before the slots are reused
+            for _ in range(sent - len(ready) - k - 1):
+                self.done.get()
+
+    def start_workers(self):
+        from multiprocessing import Process, Queue
+        from gesture.utils.shared import SharedArray, start_resource_tracker
+        start_resource_tracker()
+        self.slots = [(SharedArray((self.batch_size, *self.state_shape), np.float32),
+                       SharedArray((self.batch_size, *self.obs_shape), np.uint8))
+                      for _ in range(2 * self.num_workers)]
+        self.tasks, self.done = Queue(), Queue()
+        self.ps = [Process(target=gather_worker,
+                           args=(self.state, self.obs, self.slots, self.tasks, self.done))
+                   for _ in range(self.num_workers)]
+        for p in self.ps:
+            p.daemon = True
+            p.start()
+
+    def close(self):
+        if not self.ps:
+            return
+        for _ in self.ps:
+            self.tasks.put(None)
+        for p in self.ps:
+            p.join()
+        for states, obs in self.slots:
+            states.close()
+            obs.close()
+        self.ps = []
+
+
+class Prefetcher(object):
+    '''Iterates `loader` in a background thread, keeping up to `k` batches
+    ready ahead of the consumer (k=0: no thread).
+    After a pass `wait` is the time the consumer was blocked waiting for data.
+    '''
+    END = object()
+
+    def __init__(self, loader, k=2):
+        self.loader = loader
+        self.k = k
+        self.wait = 0
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.wait = 0
+        if self.k == 0:
+            t0 = time.time()
+            for batch in self.loader:
+                self.wait += time.time() - t0
+                yield batch
+                t0 = time.time()
+            return
+        q = queue.Queue(maxsize=self.k)
+        stop = threading.Event()
+        thread = threading.Thread(target=self.produce, args=(q, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                t0 = time.time()
+                batch = q.get()
+                self.wait += time.time() - t0
+                if batch is self.END:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            # stopped early: unblock the thread and let it close the loader
+            stop.set()
+            while thread.is_alive():
+                try:
+                    q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+    def produce(self, q, stop):
+        batches = iter(self.loader)
+        try:
+            for batch in batches:
+                q.put(batch)
+                if stop.is_set():
+                    break
+        except Exception as e:
+            q.put(e)
+        finally:
+            if hasattr(batches, 'close'):
+                batches.close()
+        q.put(self.END)
+
+
+def gather_worker(state, obs, slots, tasks, done):
+    ''' Copies the rows of batch k into shared memory slot k % len(slots) '''
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        k, idx = task
+        states, observations = slots[k % len(slots)]
+        np.take(state, idx, axis=0, out=states.array[:len(idx)], mode='clip')
+        np.take(obs, idx, axis=0, out=observations.array[:len(idx)], mode='clip')
+        done.put(k)
+
+
+def contiguous_states(states, vel=0, chunk=4096):
+    ''' float32 (N, S) without the last `vel` columns '''
+    s_shape = np.asarray(states[0]).shape[0] - vel
+    if isinstance(states, np.ndarray) and states.dtype == np.float32 and vel == 0:
+        return states
+    out = np.empty((len(states), s_shape), dtype=np.float32)
+    for i in range(0, len(states), chunk):
+        out[i:i+chunk] = np.asarray(states[i:i+chunk])[:, :s_shape]
+    return out
+
+
+def contiguous_obs(obs, chunk=4096):
+    ''' uint8 (N, C, H, W), obs are (N, H, W, C) '''
+    if isinstance(obs, np.ndarray) and obs.transpose(0, 3, 1, 2).flags['C_CONTIGUOUS']:
+        return obs.transpose(0, 3, 1, 2)  # prepared targets, no copy
+    H, W, C = np.asarray(obs[0]).shape
+    out = np.empty((len(obs), C, H, W), dtype=np.uint8)
+    for i in range(0, len(obs), chunk):
+        out[i:i+chunk] = np.asarray(obs[i:i+chunk]).transpose(0, 3, 1, 2)
+    return out
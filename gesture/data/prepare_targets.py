@@ -0,0 +1,33 @@
+'''
+Prepare target files for training, once.
+
+ex:
+
+Bash:
+
+    python prepare_targets.py --train-target-path=/FILE/PATH/train.h5 --test-target-path=/FILE/PATH/test.h5 --env-id=SocialReacher
+
+Writes next to every target file (train, val and test) a directory
+
+    /FILE/PATH/{NAME}_prepared_nospeed{NJOINTS}/    (NJOINTS: 2 reacher, 6 humanoid)
+        states.npy  float32 states without speed (with --speed: all columns)
+        obs.npy     uint8 observations (N, C, H, W)
+        meta.json
+
+which `TargetLoader` (main.py, enjoy.py, eval scripts, ...) and
+Understand_main.py memory map instead of reading the target file. The cache
+is ignored once the target file changes, run this again.
+'''
+from gesture.utils.arguments import get_args
+from gesture.environments.utils import env_from_args
+from gesture.utils.utils import prepare_targets
+
+
+if __name__ == '__main__':
+    args = get_args()
+    env_from_args(args)  # sets args.njoints, the speed columns of the targets
+    njoints = None if args.speed else args.njoints
+    paths = [args.train_target_path, args.val_target_path, args.test_target_path]
+    for path in sorted(set(paths), key=paths.index):
+        print('Preparing:', path)
+        print('\t->', prepare_targets(path, njoints))
@@ -28,8 +28,8 @@ from itertools import count
 from tqdm import tqdm
 
 from gesture.utils.arguments import get_args
-from gesture.utils.utils import record, load_dict, get_model, get_targets
-from gesture.agent.memory import Current, Targets
+from gesture.utils.utils import record, get_model
+from gesture.agent.memory import Current, TargetLoader
 from gesture.models.combine import CombinePolicy, SemiCombinePolicy
 from gesture.environments.utils import env_from_args
 
@@ -96,9 +96,7 @@ if __name__ == '__main__':
 
     print('\nLoading targets from:')
     print('path:\t', args.test_target_path)
-    datadict = load_dict(args.test_target_path)
-    targets = Targets(1, datadict)
-    targets.remove_speed(args.njoints)
+    targets = TargetLoader(args.test_target_path, args.njoints)()
 
     s_target, o_target = targets()  # random
     st_shape = s_target.shape[0]  # targets
@@ -1,5 +1,7 @@
 import numpy as np
 from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
+from gesture.utils.shared import SharedArray, start_resource_tracker
 
 # from OpenAI-baselines ´baselines/common/vec_env/subproc_vec_env.py´
 #
@@ -21,45 +23,141 @@ class CloudpickleWrapper(object):
         self.x = pickle.loads(ob)
 
 
+def stack(arrays):
+    ''' np.stack, but None if the envs do not observe it (observation_mode) '''
+    return None if arrays[0] is None else np.stack(arrays)
+
+
+def concatenate(arrays):
+    return None if arrays[0] is None else np.concatenate(arrays)
+
+
 def worker_social(remote, parent_remote, env_fn_wrapper):
+    ''' Owns and steps one or several envs, results are batched over them '''
     parent_remote.close()
-    env = env_fn_wrapper.x()
+    envs = [env_fn() for env_fn in env_fn_wrapper.x]
+    shared = None  # {'first', 'state', 'obs', 's_target', 'o_target'} in shared memory mode
+    targets = None  # own copy of the target set, see `load_targets`
+    sent_version = [None] * len(envs)  # env.target_version the parent already knows about
+
+    def observe(i, s, s_target, o, o_target):
+        ''' Targets are only sent along when they changed since last time '''
+        target = None
+        if envs[i].target_version != sent_version[i]:
+            target = (s_target, o_target)
+            sent_version[i] = envs[i].target_version
+        return s, o, target
+
+    def reply(observations, *rest):
+        s, o, targets = zip(*observations)
+        if shared is None:
+            remote.send((stack(s), stack(o)) + rest + (targets,))
+        else:
+            rows = slice(shared['first'], shared['first'] + len(envs))
+            if shared['state'] is not None:
+                shared['state'].array[rows] = s
+            if shared['obs'] is not None and \
+                    any(frame is not env.rgb_out for frame, env in zip(o, envs)):
+                shared['obs'].array[rows] = o
+            remote.send(rest + (targets,))
+
     while True:
         cmd, data = remote.recv()
         if cmd == 'step':
-            s, s_target, o, o_target, reward, done, info = env.step(data)
-            if done:
-                s, s_target, o, o_target = env.reset()
-            remote.send((s, s_target, o, o_target, reward, done, info))
+            observations, rewards, dones, infos = [], [], [], []
+            for i, (env, action) in enumerate(zip(envs, data)):
+                s, s_target, o, o_target, reward, done, info = env.step(action)
+                if done:
+                    s, s_target, o, o_target = env.reset()
+                observations.append(observe(i, s, s_target, o, o_target))
+                rewards.append(reward)
+                dones.append(done)
+                infos.append(info)
+            reply(observations, np.stack(rewards), np.stack(dones), infos)
         elif cmd == 'reset':
-            s, s_target, o, o_target = env.reset()
-            remote.send((s, s_target, o, o_target))
+            reply([observe(i, *env.reset()) for i, env in enumerate(envs)])
         elif cmd == 'reset_task':
-            ob = env.reset_task()
-            remote.send(ob)
+            remote.send([env.reset_task() for env in envs])
         elif cmd == 'close':
             remote.close()
             break
         elif cmd == 'get_spaces':
+            env = envs[0]
             remote.send((env.action_space, env.state_space, env.observation_space))
+        elif cmd == 'get_shapes':
+            # actual array shapes returned by step (rgb is (H, W, C)), None if not observed
+            env = envs[0]
+            s_shape = None if env.observation_mode == 'rgb' else env.state_space.shape
+            o_shape = None if env.observation_mode == 'state' else (env.VIDEO_H, env.VIDEO_W, 3)
+            remote.send((s_shape, o_shape))
+        elif cmd == 'attach':
+            if shared is None:
+                shared = data
+            else:
+                shared.update(data)
+            if data.get('obs') is not None:
+                # envs render straight into their shared memory slot
+                for i, env in enumerate(envs):
+                    env.rgb_out = shared['obs'].array[shared['first'] + i]
+            remote.send(True)
         elif cmd == 'render':
-            remote.send(( env.render(data) ))
+            remote.send([env.render(mode) for env, mode in zip(envs, data)])
         elif cmd == 'set_target':
-            remote.send(( env.set_target(data) ))
+            if data is None:
+                # targets already written to shared memory by the parent
+                rows = range(shared['first'], shared['first'] + len(envs))
+                data = [[shared['s_target'].array[j].copy(),
+                         shared['o_target'].array[j].copy()] for j in rows]
+            for i, (env, target) in enumerate(zip(envs, data)):
+                env.set_target(target)
+                sent_version[i] = env.target_version  # the parent keeps its own copy
+            remote.send(None)
+        elif cmd == 'load_targets':
+            targets = data.x()
+            remote.send(len(targets))
+        elif cmd == 'set_target_index':
+            for i, (env, idx) in enumerate(zip(envs, data)):
+                env.set_target(targets[idx])
+                sent_version[i] = env.target_version
+            remote.send(None)
         else:
             raise NotImplementedError
 
 
 class SubprocVecEnv_Social(object):
-    def __init__(self, env_fns):
+    def __init__(self, env_fns, shared=False, envs_per_worker=1):
         """
         envs: list of gym environments to run in subprocesses
+
+        shared: bool, if True the workers write state/obs (and read targets)
+        directly in preallocated shared memory blocks of shape (num_proc, ...)
+        and only rewards, dones and infos are sent through the pipes.
+
+        envs_per_worker: int, number of envs owned and stepped in a loop by
+        each worker process. Fewer processes and pipe round-trips when the
+        number of envs is larger than the number of cores.
+
+        Targets are cached in the parent and only sent through the pipes when
+        they change. `self.target_version[i]` is incremented every time the
+        target of env `i` changes, which lets `Current` skip unchanged targets.
+        The returned target arrays are never written to, a new array is
+        created on change. After `load_targets` the workers hold their own
+        copy of the target set and `set_target` only sends dataset indices.
         """
         self.closed = False
         nenvs = len(env_fns)
-        self.remotes, self.work_remotes = zip(*[Pipe() for _ in range(nenvs)])
-        self.ps = [Process(target=worker_social, args=(work_remote, remote, CloudpickleWrapper(env_fn)))
-            for (work_remote, remote, env_fn) in zip(self.work_remotes, self.remotes, env_fns)]
+        if shared:
+            start_resource_tracker()
+
+        # env indices owned by each worker
+        self.worker_envs = [list(range(i, min(i + envs_per_worker, nenvs)))
+                            for i in range(0, nenvs, envs_per_worker)]
+        self.env_worker = [w for w, envs in enumerate(self.worker_envs) for _ in envs]
+        nworkers = len(self.worker_envs)
+        self.remotes, self.work_remotes = zip(*[Pipe() for _ in range(nworkers)])
+        self.ps = [Process(target=worker_social,
+                           args=(work_remote, remote, CloudpickleWrapper([env_fns[i] for i in envs])))
+            for (work_remote, remote, envs) in zip(self.work_remotes, self.remotes, self.worker_envs)]
         for p in self.ps:
             p.daemon = True # if the main process crashes, we should not cause things to hang
             p.start()
@@ -69,41 +167,211 @@ class SubprocVecEnv_Social(object):
         self.remotes[0].send(('get_spaces', None))
         self.action_space, self.state_space, self.observation_space = self.remotes[0].recv()
 
+        self.s_target = None
+        self.o_target = None
+        self.target_version = np.zeros(nenvs, dtype=np.int64)
+        self.pending_targets = None  # set by `set_target`, seen from the next step/reset
+        self.pending = np.zeros(nenvs, dtype=bool)
+        self.waiting = []  # workers stepping asynchronously
+        self.worker_targets = False  # workers hold the target set (`load_targets`)
+
+        self.shared = shared
+        self.buffers = {}
+        if shared:
+            self.remotes[0].send(('get_shapes', None))
+            s_shape, o_shape = self.remotes[0].recv()
+            if s_shape is not None:
+                self.buffers['state'] = SharedArray((nenvs, *s_shape), np.float64)
+            if o_shape is not None:
+                self.buffers['obs'] = SharedArray((nenvs, *o_shape), np.uint8)
+            self._attach(state=self.buffers.get('state'), obs=self.buffers.get('obs'))
+
+    def _attach(self, **buffers):
+        ''' Sends shared buffers to the workers (pickled by name only) '''
+        for remote, envs in zip(self.remotes, self.worker_envs):
+            remote.send(('attach', dict(buffers, first=envs[0])))
+        [remote.recv() for remote in self.remotes]
+
+    def _shared_targets(self, s_target, o_target):
+        ''' (Re)allocates the shared target blocks if the target shapes change '''
+        st = self.buffers.get('s_target')
+        ot = self.buffers.get('o_target')
+        if st is None or st.shape != s_target.shape or st.dtype != s_target.dtype \
+                or ot.shape != o_target.shape or ot.dtype != o_target.dtype:
+            if st is not None:
+                st.close()
+                ot.close()
+            st = SharedArray(s_target.shape, s_target.dtype)
+            ot = SharedArray(o_target.shape, o_target.dtype)
+            self.buffers['s_target'], self.buffers['o_target'] = st, ot
+            self._attach(s_target=st, o_target=ot)
+        return st.array, ot.array
+
+    def _update_targets(self, indices, targets):
+        '''
+        Applies targets set since the envs in `indices` last stepped and the
+        (rare) targets sent back by workers whose env changed its own target.
+        '''
+        changed = {}
+        if self.pending_targets is not None:
+            for i in indices:
+                if self.pending[i]:
+                    changed[i] = (self.pending_targets[0][i], self.pending_targets[1][i])
+                    self.pending[i] = False
+            if not self.pending.any():
+                self.pending_targets = None
+        for i, target in zip(indices, targets):
+            if target is not None:
+                changed[i] = target
+        if changed:
+            if len(changed) == self.num_envs:
+                self.s_target = np.stack([np.asarray(changed[i][0]) for i in range(self.num_envs)])
+                self.o_target = np.stack([np.asarray(changed[i][1]) for i in range(self.num_envs)])
+            else:
+                self.s_target, self.o_target = self.s_target.copy(), self.o_target.copy()
+                for i, (s_target, o_target) in changed.items():
+                    self.s_target[i], self.o_target[i] = s_target, o_target
+            self.target_version[list(changed)] += 1
+        if self._all(indices):
+            return self.s_target, self.o_target
+        return self.s_target[indices], self.o_target[indices]
+
+    def _all(self, indices):
+        return len(indices) == self.num_envs and list(indices) == list(range(self.num_envs))
+
+    def _workers(self, indices):
+        ''' Workers owning the envs in `indices`, which must cover whole workers '''
+        workers = []
+        for i in indices:
+            if self.env_worker[i] not in workers:
+                workers.append(self.env_worker[i])
+        assert sorted(indices) == sorted(i for w in workers for i in self.worker_envs[w]), \
+            'indices must cover all envs of a worker (envs_per_worker={})'.format(len(self.worker_envs[0]))
+        return workers
+
+    def step_async(self, actions, indices=None):
+        '''
+        Sends actions to the envs in `indices` (default: all) without waiting.
+        Collect the results with `step_wait` or `step_poll`.
+        '''
+        if indices is None:
+            indices = range(self.num_envs)
+        actions = dict(zip(indices, actions))
+        for w in self._workers(indices):
+            assert w not in self.waiting, 'worker {} is already stepping'.format(w)
+            self.remotes[w].send(('step', [actions[i] for i in self.worker_envs[w]]))
+            self.waiting.append(w)
+
+    def step_wait(self, indices=None):
+        '''
+        Blocks until the envs in `indices` (default: all waiting envs) are done
+        and returns their results stacked in the order of `indices` (grouped by
+        worker if `envs_per_worker` > 1).
+        '''
+        workers = list(self.waiting) if indices is None else self._workers(indices)
+        indices = [i for w in workers for i in self.worker_envs[w]]
+        results = [self.remotes[w].recv() for w in workers]
+        for w in workers:
+            self.waiting.remove(w)
+        if self.shared:
+            rews, dones, infos, targets = zip(*results)
+            state, obs = self._shared_observations(indices)
+        else:
+            state, obs, rews, dones, infos, targets = zip(*results)
+            state, obs = concatenate(state), concatenate(obs)
+        targets = [t for worker_targets in targets for t in worker_targets]
+        s_target, o_target = self._update_targets(indices, targets)
+        infos = tuple(info for worker_infos in infos for info in worker_infos)
+        return state, s_target, obs, o_target, np.concatenate(rews), np.concatenate(dones), infos
+
+    def step_poll(self, timeout=None):
+        '''
+        Generator yielding `(indices, results)` for the waiting envs as soon as
+        they finish stepping. `results` are the same as from `step_wait(indices)`.
+        '''
+        while self.waiting:
+            ready = wait([self.remotes[w] for w in self.waiting], timeout)
+            if not ready:
+                return
+            indices = [i for w in self.waiting if self.remotes[w] in ready
+                       for i in self.worker_envs[w]]
+            yield indices, self.step_wait(indices)
+
     def step(self, actions):
-        for remote, action in zip(self.remotes, actions):
-            remote.send(('step', action))
-        results = [remote.recv() for remote in self.remotes]
-        state, s_target,  obs, o_target, rews, dones, infos = zip(*results)
-        return np.stack(state), np.stack(s_target), \
-                                np.stack(obs), \
-                                np.stack(o_target), \
-                                np.stack(rews), \
-                                np.stack(dones), \
-                                infos
+        self.step_async(actions)
+        return self.step_wait()
+
+    def _shared_observations(self, indices=None):
+        ''' Copies out of shared memory so the next step can not overwrite returned data '''
+        copies = []
+        for name in ('state', 'obs'):
+            buf = self.buffers.get(name)
+            if buf is None:
+                copies.append(None)  # not observed (observation_mode)
+            elif indices is None or self._all(indices):
+                copies.append(buf.array.copy())
+            else:
+                copies.append(buf.array[indices])
+        return copies
 
     def render(self, modes):
-        for remote, mode in zip(self.remotes, modes):
-            remote.send(('render', mode))
-        results = [remote.recv() for remote in self.remotes]
+        for remote, envs in zip(self.remotes, self.worker_envs):
+            remote.send(('render', [modes[i] for i in envs]))
+        results = [r for remote in self.remotes for r in remote.recv()]
         human, machine, target = zip(*results)
         return np.stack(human), np.stack(machine), np.stack(target)
 
+    def load_targets(self, loader):
+        '''
+        Every worker opens its own copy of the target set with `loader`
+        (picklable, e.g. `TargetLoader`, memory mapped: the pages are shared).
+        From then on `set_target` with a `TargetBatch` (from `Targets.__call__`)
+        only sends the dataset indices to the workers.
+        '''
+        for remote in self.remotes:
+            remote.send(('load_targets', CloudpickleWrapper(loader)))
+        lengths = [remote.recv() for remote in self.remotes]
+        assert len(set(lengths)) == 1, 'workers loaded different target sets'
+        self.worker_targets = True
+
     def set_target(self, targets):
-        for remote, target in zip(self.remotes, targets):
-            remote.send(('set_target', target))
+        ''' targets: list of [state, obs] per env or a `TargetBatch` '''
+        if hasattr(targets, 'states'):
+            s_target, o_target = targets.states, targets.obs
+        else:
+            s_target = np.stack([np.asarray(t[0]) for t in targets])
+            o_target = np.stack([np.asarray(t[1]) for t in targets])
+        self.pending_targets = (s_target, o_target)
+        self.pending[:] = True
+        if self.worker_targets and getattr(targets, 'indices', None) is not None:
+            for remote, envs in zip(self.remotes, self.worker_envs):
+                remote.send(('set_target_index', [int(targets.indices[i]) for i in envs]))
+        else:
+            if self.shared:
+                st, ot = self._shared_targets(s_target, o_target)
+                st[:], ot[:] = s_target, o_target
+            for remote, envs in zip(self.remotes, self.worker_envs):
+                remote.send(('set_target', None if self.shared else [targets[i] for i in envs]))
         results = [remote.recv() for remote in self.remotes]
 
     def reset(self):
         for remote in self.remotes:
             remote.send(('reset', None))
         results = [remote.recv() for remote in self.remotes]
-        s, s_target, o, o_target = zip(*results)
-        return np.stack(s), np.stack(s_target), np.stack(o), np.stack(o_target)
+        if self.shared:
+            targets = [r[0] for r in results]
+            s, o = self._shared_observations()
+        else:
+            s, o, targets = zip(*results)
+            s, o = concatenate(s), concatenate(o)
+        targets = [t for worker_targets in targets for t in worker_targets]
+        s_target, o_target = self._update_targets(range(self.num_envs), targets)
+        return s, s_target, o, o_target
 
     def reset_task(self):
         for remote in self.remotes:
             remote.send(('reset_task', None))
-        return np.stack([remote.recv() for remote in self.remotes])
+        return np.stack([ob for remote in self.remotes for ob in remote.recv()])
 
     def close(self):
         if self.closed:
@@ -112,8 +380,10 @@ class SubprocVecEnv_Social(object):
             remote.send(('close', None))
         for p in self.ps:
             p.join()
+        for buf in self.buffers.values():
+            buf.close()
         self.closed = True
 
     @property
     def num_envs(self):
-        return len(self.remotes)
+        return len(self.env_worker)
@@ -29,7 +29,7 @@ class SocialReacherTargets(SocialReacher):
         '''
         self.state_target = targets[0]
         self.obs_target = targets[1]
-
+        self.target_version += 1
 
         for j in self.target_joints.values():
             j.reset_current_position(self.np_random.uniform(low=-0.01, high=0.01 ), 0)
@@ -76,12 +76,6 @@ class SocialReacherTargets(SocialReacher):
         self.calc_robot_keypoints()  # calcs target_position, important_pos, to_target_vec
         return np.concatenate((self.robot_key_points, self.joint_speeds))
 
-    def get_rgb(self):
-        self.camera_adjust()
-        rgb, _, _, _, _ = self.camera.render(False, False, False) # render_depth, render_labeling, print_timing)
-        rendered_rgb = np.fromstring(rgb, dtype=np.uint8).reshape( (self.VIDEO_H,self.VIDEO_W,3) )
-        return rendered_rgb
-
     def camera_adjust(self):
         ''' Vision from straight above '''
         self.camera.move_and_look_at( 0, 0, 1, 0, 0, 0.4)
@@ -8,6 +8,8 @@ import gym
 from OpenGL import GLE # fix for opengl issues on desktop  / nvidia
 import cv2
 
+from gesture.environments.SubProcEnv import stack
+
 
 PATH_TO_CUSTOM_XML = os.path.join(os.path.dirname(__file__), "xml_files")
 
@@ -27,8 +29,11 @@ class MyGymEnv(gym.Env):
         'render.modes': ['human', 'machine', 'target', 'all', 'all_rgb_array'],
         'video.frames_per_second': 60
         }
-    def __init__(self, action_dim=2, state_dim=7, obs_dim=(600, 400, 3)):
-        self.scene = None
+    def __init__(self, action_dim=2, state_dim=7, obs_dim=(600, 400, 3), scene=None,
+                 observation_mode='both'):
+        assert observation_mode in ('state', 'rgb', 'both')
+        self.observation_mode = observation_mode  # `state` never renders
+        self.scene = scene
         self.VIDEO_W = obs_dim[0]
         self.VIDEO_H = obs_dim[1]
 
@@ -45,12 +50,34 @@ class MyGymEnv(gym.Env):
 
         self.state_target = None
         self.obs_target = None
+        self.target_version = 0  # incremented every time the targets change
+        self._camera = None        # created on first use, see `camera`
+        self._human_camera = None
+        self.rgb_out = None        # optional (H, W, 3) uint8 array get_rgb writes into
         if self.scene is None:
             ''' First reset '''
             self.scene = self.initialize_scene()
-            # If load_xml_get_robot() is moved outside this condition after
-            # env.reset all states become nan
-            self.load_xml_get_robot()
+        # If load_xml_get_robot() is moved outside __init__ after
+        # env.reset all states become nan
+        self.load_xml_get_robot()
+
+    @property
+    def camera(self):
+        ''' Observation camera, created once and reused across resets '''
+        if self._camera is None:
+            self._camera = self.scene.cpp_world.new_camera_free_float(self.VIDEO_W,
+                                                                      self.VIDEO_H,
+                                                                      "video_camera")
+        return self._camera
+
+    @property
+    def human_camera(self):
+        ''' Large camera, only created when a human/record render mode is used '''
+        if self._human_camera is None:
+            self._human_camera = self.scene.cpp_world.new_camera_free_float(self.Human_VIDEO_W,
+                                                                            self.Human_VIDEO_H,
+                                                                            "human_video_camera")
+        return self._human_camera
 
     def _seed(self, seed=None):
         self.np_random, seed = gym.utils.seeding.np_random(seed)
@@ -66,38 +93,68 @@ class MyGymEnv(gym.Env):
         self.done = False
         self.frame = 0
         self.reward = 0
-        self.camera = self.scene.cpp_world.new_camera_free_float(self.VIDEO_W,
-                                                                 self.VIDEO_H,
-                                                                 "video_camera")
-        self.human_camera = self.scene.cpp_world.new_camera_free_float(self.Human_VIDEO_W,
-                                                                       self.Human_VIDEO_H,
-                                                                       "human_video_camera")
 
         if self.state_target is None:
             print('Random Targets. Use "env.set_target(state, obs)"')
             self.state_target = np.random.randint(4)
             self.obs_target = np.random.randint(0, 255, (100,100,3)).astype('uint8')
+            self.target_version += 1
 
         state_robot = self.calc_state()  # pos and speed
         self.potential = self.calc_potential()  # potential to target
-        obs = self.get_rgb()  #observation
+        state_robot, obs = self.observe(state_robot)
 
         return (state_robot, self.state_target, obs, self.obs_target)
 
     def _step(self, a):
+        ''' The action is held for `action_repeat` physics steps, only the last one is observed '''
         self.apply_action(a)  # Singleplayer (originally in a condition)
-        self.scene.global_step()
+        reward = 0
+        for _ in range(self.action_repeat):
+            self.scene.global_step()
+            reward += self.physics_step(a)
+        return self.after_step(reward)
+
+    def physics_step(self, a):
+        ''' Everything after one `global_step` (SocialBatch steps the scene once for all envs) '''
         self.frame  += 1
+        self.state = self.calc_state()  # also calculates self.joints_at_limit
+        return self.calc_reward(a)
 
-        state = self.calc_state()  # also calculates self.joints_at_limit
-        reward = self.calc_reward(a)
+    def after_step(self, reward):
+        ''' Observation of the last physics step, `reward` summed over the action repeat '''
         done = self.stop_condition() # max frame reached?
         self.done = done
         self.reward = reward
 
-        obs = self.get_rgb()
+        state, obs = self.observe(self.state)
         return (state, self.state_target, obs, self.obs_target, reward, bool(done), {})
 
+    def observe(self, state):
+        ''' Returns (state, obs) according to `self.observation_mode`.
+        The state is always calculated (reward) but only rendered if needed.
+        '''
+        obs = None if self.observation_mode == 'state' else self.get_rgb(self.rgb_out)
+        if self.observation_mode == 'rgb':
+            state = None
+        return state, obs
+
+    def get_rgb(self, out=None):
+        ''' Observation frame (H, W, 3) uint8.
+        :param out   array to write the frame into (e.g a shared memory slot).
+        Without `out` a read-only view of the rendered bytes is returned (no copy).
+        '''
+        self.camera_adjust()
+        return self.render_camera(self.camera, self.VIDEO_H, self.VIDEO_W, out)
+
+    def render_camera(self, camera, height, width, out=None):
+        rgb, _, _, _, _ = camera.render(False, False, False) # render_depth, render_labeling, print_timing)
+        frame = np.frombuffer(rgb, dtype=np.uint8).reshape((height, width, 3))
+        if out is None:
+            return frame
+        out[...] = frame
+        return out
+
     def _render(self, mode, close):
         def cv2_render(rgb, title='frame'):
             cv2.imshow(title, cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR))
@@ -108,14 +165,11 @@ class MyGymEnv(gym.Env):
             return
         if mode=='human':
             self.human_camera_adjust()
-            rgb, _, _, _, _ = self.human_camera.render(False, False, False) # render_depth, render_labeling, print_timing)
-            rendered_rgb = np.fromstring(rgb, dtype=np.uint8).reshape( (self.Human_VIDEO_H, self.Human_VIDEO_W,3) )
+            rendered_rgb = self.render_camera(self.human_camera, self.Human_VIDEO_H, self.Human_VIDEO_W)
             cv2_render(rendered_rgb, 'human')
             return [True, False, False]
         elif mode=="machine":
-            self.camera_adjust()
-            rgb, _, _, _, _ = self.camera.render(False, False, False) # render_depth, render_labeling, print_timing)
-            rendered_rgb = np.fromstring(rgb, dtype=np.uint8).reshape( (self.VIDEO_H,self.VIDEO_W,3) )
+            rendered_rgb = self.get_rgb()
             cv2_render(rendered_rgb, 'machine')
             return [False, True, False]
         elif mode=="target":
@@ -127,27 +181,29 @@ class MyGymEnv(gym.Env):
             self._render('target', False)
             return [True, True, True]
         elif mode=="all_rgb_array":
-            self.camera_adjust()
-            rgb, _, _, _, _ = self.camera.render(False, False, False) # render_depth, render_labeling, print_timing)
-            machine = np.fromstring(rgb, dtype=np.uint8).reshape( (self.VIDEO_H,self.VIDEO_W,3) )
-
+            machine = self.get_rgb()
             self.human_camera_adjust()
-            rgb, _, _, _, _ = self.human_camera.render(False, False, False) # render_depth, render_labeling, print_timing)
-            human = np.fromstring(rgb, dtype=np.uint8).reshape( (self.Human_VIDEO_H, self.Human_VIDEO_W,3) )
+            human = self.render_camera(self.human_camera, self.Human_VIDEO_H, self.Human_VIDEO_W)
             return human, machine, self.obs_target
         else:
             assert(0)
 
 
 class Base(MyGymEnv):
+    key_parts = ()  # body parts whose positions are the robot keypoints (state and reward)
+    key_dims = 3    # number of coordinates used per keypoint
+
     def __init__(self, XML_PATH=PATH_TO_CUSTOM_XML,
                  robot_name='robot',
                  model_xml='NOT/A/FILE.xml',
                  ac=2, st=6,
-                 args=None):
+                 args=None,
+                 scene=None,
+                 offset=(0, 0, 0)):
         self.XML_PATH    = XML_PATH
         self.model_xml   = model_xml
         self.robot_name  = robot_name
+        self.offset      = np.array(offset, dtype=np.float64)  # robot position in a shared scene
         if args is None:
             ''' Defaults '''
             self.MAX_TIME             = 300
@@ -163,10 +219,11 @@ class Base(MyGymEnv):
             self.gravity              = 9.81
             self.timestep             = 0.0165/4
             self.frame_skip           = 1
+            self.action_repeat        = 1
 
             # Robot
             self.power                = 0.5
-            MyGymEnv.__init__(self, action_dim=ac, state_dim=st)
+            MyGymEnv.__init__(self, action_dim=ac, state_dim=st, scene=scene)
         else:
             self.MAX_TIME=args.MAX_TIME
 
@@ -183,13 +240,16 @@ class Base(MyGymEnv):
             self.gravity              = args.gravity
             self.timestep             = 0.0165/4
             self.frame_skip           = 1
+            self.action_repeat        = args.action_repeat  # physics steps per action
 
             # Robot
             self.power                = args.power # 0.5
             MyGymEnv.__init__(self,
                               action_dim=ac,
                               state_dim=st,
-                              obs_dim=(args.video_w, args.video_h, args.video_c))
+                              obs_dim=(args.video_w, args.video_h, args.video_c),
+                              scene=scene,
+                              observation_mode=args.observation_mode or 'both')
 
     def initialize_scene(self):
         return Scene(self.gravity, self.timestep, self.frame_skip)
@@ -206,10 +266,14 @@ class Base(MyGymEnv):
         return max_time
 
     def load_xml_get_robot(self, verbose=False):
-        self.mjcf = self.scene.cpp_world.load_mjcf(
-            os.path.join(os.path.dirname(__file__),
-                         "xml_files/",
-                         self.model_xml))
+        xml = os.path.join(os.path.dirname(__file__), "xml_files/", self.model_xml)
+        if self.offset.any():
+            # robot in a shared scene (SocialBatch)
+            xml = offset_xml(xml, self.offset)
+            self.mjcf = self.scene.cpp_world.load_mjcf(xml)
+            os.remove(xml)
+        else:
+            self.mjcf = self.scene.cpp_world.load_mjcf(xml)
         self.ordered_joints = []
         self.jdict = {}
         self.parts = {}
@@ -245,12 +309,39 @@ class Base(MyGymEnv):
         ''' This function separates all parts/joints by containing `robot` or `target`.'''
         self.robot_joints, self.robot_parts = self.get_joints_parts_by_name('robot')
         self.target_joints, self.target_parts = self.get_joints_parts_by_name('target') # used only in SocialReacher_targets
+
+        # Lookup tables and buffers for calc_state, nothing is searched or allocated per step
+        self.joint_positions = [j.current_relative_position for j in self.robot_joints.values()]
+        self.joint_buffer = np.zeros((len(self.joint_positions), 2), dtype=np.float32)  # (pos, speed)
+        self.key_poses = [self.parts[name].pose for name in self.key_parts]
+        self.key_buffer = np.zeros((len(self.key_poses), 3))
+        self.state_buffer = np.zeros(len(self.key_poses)*self.key_dims + len(self.joint_positions))
         if verbose:
             print('{}\n'.format(self.robot_joints))
             print('{}\n'.format(self.robot_parts))
             print('{}\n'.format(self.target_joints))
         assert(self.cpp_robot)
 
+    def calc_robot_keypoints(self):
+        ''' positions of `key_parts` relative to the env offset '''
+        for i, pose in enumerate(self.key_poses):
+            self.key_buffer[i] = pose().xyz()
+        key_points = self.key_buffer[:, :self.key_dims] - self.offset[:self.key_dims]
+        self.robot_key_points = key_points.reshape(-1)
+
+    def calc_state(self):
+        ''' keypoints and joint speeds, also calculates self.joints_at_limit '''
+        for i, position in enumerate(self.joint_positions):
+            self.joint_buffer[i] = position()
+        self.joints_at_limit = np.count_nonzero(np.abs(self.joint_buffer[:, 0]) > 0.99)
+        self.joint_speeds = self.joint_buffer[:, 1]
+        self.calc_robot_keypoints()
+
+        n = len(self.robot_key_points)
+        self.state_buffer[:n] = self.robot_key_points
+        self.state_buffer[n:] = self.joint_speeds
+        return self.state_buffer.copy()  # returned states are kept by the callers
+
     def get_joints_parts_by_name(self, name):
         joints, parts =  {}, {}
         for jname, joint in self.jdict.items():
@@ -263,11 +354,15 @@ class Base(MyGymEnv):
 
 
 class SocialReacher(Base):
-    def __init__(self, args=None):
+    key_parts = ('robot_elbow', 'robot_hand')
+    key_dims = 2  # (x, y)
+
+    def __init__(self, args=None, scene=None, offset=(0, 0, 0)):
         Base.__init__(self, XML_PATH=PATH_TO_CUSTOM_XML,
                       robot_name='robot_arm',
                       model_xml='SocialPlane.xml',
-                      ac=2, st=6, args=args)
+                      ac=2, st=6, args=args,
+                      scene=scene, offset=offset)
         print('I am', self.model_xml)
 
     def set_target(self, targets):
@@ -279,6 +374,7 @@ class SocialReacher(Base):
         '''
         self.state_target = targets[0]
         self.obs_target = targets[1]
+        self.target_version += 1
         assert type(targets[0]) is np.ndarray, 'state target must be numpy'
         assert type(targets[1]) is np.ndarray, 'obs target must be numpy'
 
@@ -296,12 +392,6 @@ class SocialReacher(Base):
             j.reset_current_position(self.np_random.uniform(low=-0.01, high=0.01 ), 0)
             j.set_motor_torque(0)
 
-    def calc_robot_keypoints(self):
-        ''' gets hand position, target position and the vector in bewteen'''
-        elbow_position = np.array(self.parts['robot_elbow'].pose().xyz())[:2]
-        hand_position = np.array(self.parts['robot_hand'].pose().xyz())[:2]
-        self.robot_key_points = np.concatenate((elbow_position, hand_position))
-
     def calc_reward(self, a):
         ''' Difference potential as reward '''
         potential_old = self.potential
@@ -314,36 +404,27 @@ class SocialReacher(Base):
         p = -self.potential_constant*np.linalg.norm(self.diff_key_points)
         return np.array(p)
 
-    def calc_state(self):
-        j = np.array([j.current_relative_position()
-                      for j in self.robot_joints.values()],
-                     dtype=np.float32).flatten()
-        self.joints_at_limit = np.count_nonzero(np.abs(j[0::2]) > 0.99)
-        self.joint_speeds = j[1::2]
-        self.calc_robot_keypoints()  # calcs target_position, important_pos, to_target_vec
-        return np.concatenate((self.robot_key_points, self.joint_speeds))
-
-    def get_rgb(self):
-        self.camera_adjust()
-        rgb, _, _, _, _ = self.camera.render(False, False, False) # render_depth, render_labeling, print_timing)
-        rendered_rgb = np.fromstring(rgb, dtype=np.uint8).reshape( (self.VIDEO_H,self.VIDEO_W,3) )
-        return rendered_rgb
-
     def camera_adjust(self):
         ''' Vision from straight above '''
-        self.camera.move_and_look_at( 0, 0, 1, 0, 0, 0.4)
+        x, y, z = self.offset
+        self.camera.move_and_look_at(x, y, z+1, x, y, z+0.4)
 
     def human_camera_adjust(self):
         ''' Vision from straight above '''
-        self.human_camera.move_and_look_at( 0, 0, 1, 0, 0, 0.4)
+        x, y, z = self.offset
+        self.human_camera.move_and_look_at(x, y, z+1, x, y, z+0.4)
 
 
 class SocialHumanoid(Base):
-    def __init__(self, args=None):
+    key_parts = ('robot_left_elbow', 'robot_left_hand', 'robot_right_elbow', 'robot_right_hand')
+    key_dims = 3  # (x, y, z)
+
+    def __init__(self, args=None, scene=None, offset=(0, 0, 0)):
         Base.__init__(self, XML_PATH=PATH_TO_CUSTOM_XML,
                       robot_name='robot',
                       model_xml='SocialHumanoid.xml',
-                      ac=6, st=18, args=args)
+                      ac=6, st=18, args=args,
+                      scene=scene, offset=offset)
         print('I am', self.model_xml)
 
     def set_target(self, targets):
@@ -355,6 +436,7 @@ class SocialHumanoid(Base):
         '''
         self.state_target = targets[0]
         self.obs_target = targets[1]
+        self.target_version += 1
         assert type(targets[0]) is np.ndarray, 'state target must be numpy'
         assert type(targets[1]) is np.ndarray, 'obs target must be numpy'
 
@@ -377,17 +459,6 @@ class SocialHumanoid(Base):
             j.reset_current_position(self.np_random.uniform(low=-1.1, high=1.1 ), 0)
             j.set_motor_torque(0)
 
-    def calc_robot_keypoints(self):
-        ''' gets hand position, target position and the vector in bewteen'''
-        left_elbow_position = np.array(self.parts['robot_left_elbow'].pose().xyz())
-        left_hand_position = np.array(self.parts['robot_left_hand'].pose().xyz())
-        right_elbow_position = np.array(self.parts['robot_right_elbow'].pose().xyz())
-        right_hand_position = np.array(self.parts['robot_right_hand'].pose().xyz())
-        self.robot_key_points = np.concatenate((left_elbow_position,
-                                                left_hand_position,
-                                                right_elbow_position,
-                                                right_hand_position ))
-
     def calc_reward(self, a):
         ''' Difference potential as reward '''
         potential_old = self.potential
@@ -401,38 +472,29 @@ class SocialHumanoid(Base):
         p = -self.potential_constant*np.linalg.norm(self.diff_key_points)
         return np.array(p)
 
-    def calc_state(self):
-        j = np.array([j.current_relative_position()
-                      for j in self.robot_joints.values()],
-                     dtype=np.float32).flatten()
-        self.joints_at_limit = np.count_nonzero(np.abs(j[0::2]) > 0.99)
-        self.joint_speeds = j[1::2]
-        self.calc_robot_keypoints()  # important_pos
-        return np.concatenate((self.robot_key_points, self.joint_speeds))
-
-    def get_rgb(self):
-        self.camera_adjust()
-        rgb, _, _, _, _ = self.camera.render(False, False, False) # render_depth, render_labeling, print_timing)
-        rendered_rgb = np.fromstring(rgb, dtype=np.uint8).reshape( (self.VIDEO_H,self.VIDEO_W,3) )
-        return rendered_rgb
-
     def camera_adjust(self):
         ''' camera used as observation for agent default: (40,40,3)'''
-        self.camera.move_and_look_at(1, 0, 0, 0, 0, 0)
+        x, y, z = self.offset
+        self.camera.move_and_look_at(x+1, y, z, x, y, z)
 
     def human_camera_adjust(self):
         ''' Camera used for regular rendering. Default: (400, 600, 3)'''
-        self.human_camera.move_and_look_at(1, 0, 0, 0, 0, 0)
+        x, y, z = self.offset
+        self.human_camera.move_and_look_at(x+1, y, z, x, y, z)
 
 
 #####-------------------------
 # Nothing done on this... needed for rendering reward functions again.
 class SocialReacherTargets(Base):
-    def __init__(self, args=None):
+    key_parts = ('robot_elbow', 'robot_hand')
+    key_dims = 2  # (x, y)
+
+    def __init__(self, args=None, scene=None, offset=(0, 0, 0)):
         Base.__init__(self, XML_PATH=PATH_TO_CUSTOM_XML,
                       robot_name='robot_arm',
                       model_xml='SocialPlane.xml',
-                      ac=2, st=6, args=args)
+                      ac=2, st=6, args=args,
+                      scene=scene, offset=offset)
         print('I am', self.model_xml)
 
     def set_target(self, targets):
@@ -444,6 +506,7 @@ class SocialReacherTargets(Base):
         '''
         self.state_target = targets[0]
         self.obs_target = targets[1]
+        self.target_version += 1
         assert type(targets[0]) is np.ndarray, 'state target must be numpy'
         assert type(targets[1]) is np.ndarray, 'obs target must be numpy'
 
@@ -465,12 +528,6 @@ class SocialReacherTargets(Base):
             j.reset_current_position(self.np_random.uniform(low=-0.01, high=0.01 ), 0)
             j.set_motor_torque(0)
 
-    def calc_robot_keypoints(self):
-        ''' gets hand position, target position and the vector in bewteen'''
-        elbow_position = np.array(self.parts['robot_elbow'].pose().xyz())[:2]
-        hand_position = np.array(self.parts['robot_hand'].pose().xyz())[:2]
-        self.robot_key_points = np.concatenate((elbow_position, hand_position))
-
     def calc_reward(self, a):
         ''' Difference potential as reward '''
         potential_old = self.potential
@@ -483,39 +540,133 @@ class SocialReacherTargets(Base):
         p = -self.potential_constant*np.linalg.norm(self.diff_key_points)
         return np.array(p)
 
-    def calc_state(self):
-        j = np.array([j.current_relative_position()
-                      for j in self.robot_joints.values()],
-                     dtype=np.float32).flatten()
-        self.joints_at_limit = np.count_nonzero(np.abs(j[0::2]) > 0.99)
-        self.joint_speeds = j[1::2]
-        self.calc_robot_keypoints()  # calcs target_position, important_pos, to_target_vec
-        return np.concatenate((self.robot_key_points, self.joint_speeds))
-
-    def get_rgb(self):
-        self.camera_adjust()
-        rgb, _, _, _, _ = self.camera.render(False, False, False) # render_depth, render_labeling, print_timing)
-        rendered_rgb = np.fromstring(rgb, dtype=np.uint8).reshape( (self.VIDEO_H,self.VIDEO_W,3) )
-        return rendered_rgb
-
     def camera_adjust(self):
         ''' Vision from straight above '''
-        self.camera.move_and_look_at( 0, 0, 1, 0, 0, 0.4)
+        x, y, z = self.offset
+        self.camera.move_and_look_at(x, y, z+1, x, y, z+0.4)
 
     def human_camera_adjust(self):
         ''' Vision from straight above '''
-        self.human_camera.move_and_look_at( 0, 0, 1, 0, 0, 0.4)
+        x, y, z = self.offset
+        self.human_camera.move_and_look_at(x, y, z+1, x, y, z+0.4)
 
 #####-------------------------
+def offset_xml(xml_path, offset):
+    ''' Writes a copy of a mjcf file where everything in the worldbody is
+    moved by `offset` (x, y, z) and returns the path to the copy.
+    Used to load several robots spatially separated in the same scene.
+    '''
+    import tempfile
+    import xml.etree.ElementTree as ET
+
+    def move(values, n):
+        values = np.array(values.split(), dtype=np.float64).reshape(n, 3) + offset
+        return ' '.join('{:.10g}'.format(v) for v in values.flatten())
+
+    tree = ET.parse(xml_path)
+    for element in tree.getroot().find('worldbody'):
+        if 'fromto' in element.attrib:
+            element.set('fromto', move(element.get('fromto'), 2))
+        else:
+            element.set('pos', move(element.get('pos', '0 0 0'), 1))
+    fd, path = tempfile.mkstemp(suffix='_' + os.path.basename(xml_path))
+    with os.fdopen(fd, 'wb') as f:
+        tree.write(f)
+    return path
+
+
+class SocialBatch(object):
+    ''' N robots in a single Roboschool scene.
+
+    Every env loads its robot in the same `cpp_world`, moved `spacing` meters
+    along y, so one `global_step()` simulates all of them. Same interface as
+    `SubprocVecEnv_Social` but everything runs in the calling process.
+    Meant for state only training (MLP coordination).
+
+    :param Env          SocialReacher/SocialHumanoid
+    :param args         arguments
+    :param n            int, number of robots
+    :param spacing      float, distance between robots
+    '''
+    def __init__(self, Env, args, n, spacing=10):
+        self.envs = []
+        scene = None
+        for i in range(n):
+            env = Env(args, scene=scene, offset=(0, i*spacing, 0))
+            env.seed(args.seed+i*100)
+            scene = env.scene
+            self.envs.append(env)
+        self.scene = scene
+        self.action_space = self.envs[0].action_space
+        self.state_space = self.envs[0].state_space
+        self.observation_space = self.envs[0].observation_space
+        self.observed_version = np.array([env.target_version for env in self.envs])
+
+    def step(self, actions):
+        for env, a in zip(self.envs, actions):
+            env.apply_action(a)
+        rewards = [0] * len(self.envs)
+        for _ in range(self.envs[0].action_repeat):
+            self.scene.global_step()
+            for i, (env, a) in enumerate(zip(self.envs, actions)):
+                rewards[i] += env.physics_step(a)
+        results = []
+        for env, reward in zip(self.envs, rewards):
+            s, s_target, o, o_target, reward, done, info = env.after_step(reward)
+            if done:
+                s, s_target, o, o_target = env.reset()
+            results.append((s, s_target, o, o_target, reward, done, info))
+        state, s_target, obs, o_target, rews, dones, infos = zip(*results)
+        self.observed_version = np.array([env.target_version for env in self.envs])
+        return stack(state), np.stack(s_target), stack(obs), \
+            np.stack(o_target), np.stack(rews), np.stack(dones), infos
+
+    def reset(self):
+        s, s_target, o, o_target = zip(*[env.reset() for env in self.envs])
+        self.observed_version = np.array([env.target_version for env in self.envs])
+        return stack(s), np.stack(s_target), stack(o), np.stack(o_target)
+
+    def set_target(self, targets):
+        for env, target in zip(self.envs, targets):
+            env.set_target(target)
+
+    def load_targets(self, loader):
+        ''' Targets are set in this process, nothing to send '''
+        pass
+
+    def render(self, modes):
+        results = [env.render(mode) for env, mode in zip(self.envs, modes)]
+        human, machine, target = zip(*results)
+        return np.stack(human), np.stack(machine), np.stack(target)
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+    @property
+    def target_version(self):
+        ''' Versions of the targets returned by the last step/reset. As in
+        SubprocVecEnv_Social, targets set in between only count once observed '''
+        return self.observed_version
+
+    @property
+    def num_envs(self):
+        return len(self.envs)
+
+
 def Social_multiple(Env, args):
     from gesture.environments.SubProcEnv import SubprocVecEnv_Social as SubprocVecEnv
+    if args.single_world:
+        return SocialBatch(Env, args, args.num_proc)
     def multiple_envs(Env, args, rank):
         def _thunk():
             env = Env(args)
             env.seed(args.seed+rank*100)
             return env
         return _thunk
-    return SubprocVecEnv([multiple_envs(Env, args, i) for i in range(args.num_proc)])
+    return SubprocVecEnv([multiple_envs(Env, args, i) for i in range(args.num_proc)],
+                         shared=args.shared_memory,
+                         envs_per_worker=args.envs_per_worker)
 
 
 # test functions
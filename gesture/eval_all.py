@@ -19,9 +19,9 @@ import torch
 from torch.autograd import Variable
 
 from gesture.utils.arguments import get_args
-from gesture.utils.utils import record, load_dict, get_targets, get_model
+from gesture.utils.utils import record, get_model
 from gesture.environments.utils import env_from_args
-from gesture.agent.memory import Current, Targets
+from gesture.agent.memory import Current, TargetLoader
 from gesture.models.modular import VanillaCNN
 
 class PoseDefiner(object):
@@ -183,9 +183,7 @@ if __name__ == '__main__':
 
     print('\nLoading targets from:')
     print('path:\t', args.test_target_path)
-    datadict = load_dict(args.test_target_path)
-    targets = Targets(1, datadict)
-    targets.remove_speed(args.njoints)
+    targets = TargetLoader(args.test_target_path, args.njoints)()
 
     s_target, o_target = targets()  # random
     st_shape = s_target.shape[0]  # targets
@@ -12,12 +12,15 @@ from utils.utils import get_model, get_targets
 from environments.utils import env_from_args
 from environments.social import Social_multiple
 from agent.test import Test_and_Save_Video
-from agent.train import exploration, train
+from agent.train import exploration, exploration_async, train
 from agent.memory import RolloutStorage, Results, Current, Targets
 
 
 args = get_args()
 Env = env_from_args(args)
+if args.observation_mode is None:
+    # the MLP policy never looks at the rgb observation
+    args.observation_mode = 'both' if 'Combine' in args.model else 'state'
 
 # frames -> updates
 args.num_updates = int(args.num_frames) // args.num_steps // args.num_proc
@@ -40,6 +43,8 @@ if not args.no_vis:
 
 print('\n=== Create Environment ===\n')
 env = Social_multiple(Env, args)
+if args.worker_targets:
+    env.load_targets(targets.loader)  # only target indices are sent to the workers
 
 s_shape = env.state_space.shape[0]    # Joints state
 o_shape = env.observation_space.shape  # RGB (W,H,C)
@@ -56,7 +61,9 @@ rollouts = RolloutStorage(args.num_steps,
                           current.state.size()[1],
                           current.target_state.size()[1],
                           current.obs.size()[1:],
-                          ac_shape)
+                          ac_shape,
+                          uint8_obs=args.uint8_obs,
+                          target_obs=targets.obs_tensor() if args.target_index else None)
 
 # === Model ===
 pi, Model = get_model(current, args)
@@ -83,15 +90,20 @@ print('\nTraining for %d Updates' % args.num_updates)
 
 # Initialize targets and reset env
 env.set_target(targets())  # set initial targets
+current.set_target_index(targets.indices)
 s, s_target, obs, obs_target = env.reset()
+current.apply_target_index()
 current.update(s, s_target, obs, obs_target)
 s, st, o ,ot = current()
-rollouts.first_insert(s, st, o, ot)
+rollouts.first_insert(s, st, o, ot, current.target_index)
 if args.cuda:
     current.cuda()
     rollouts.cuda()
     pi.cuda()
 
+if args.double_buffer:
+    exploration = exploration_async
+
 pi.train()
 MAX_REWARD = -99999
 for j in range(args.num_updates):
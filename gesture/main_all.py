@@ -13,7 +13,7 @@ from environments.utils import env_from_args
 from environments.social import Social_multiple
 from models.model import AllPolicy
 from agent.test import Test_and_Save_Video
-from agent.train import exploration
+from agent.train import exploration, exploration_async
 from agent.train import trainAll as train
 from agent.memory import RolloutStorage, Current, Targets
 from agent.memory import Results
@@ -42,6 +42,8 @@ if not args.no_vis:
 
 print('\n=== Create Environment ===\n')
 env = Social_multiple(Env, args)
+if args.worker_targets:
+    env.load_targets(targets.loader)  # only target indices are sent to the workers
 
 s_shape = env.state_space.shape[0]    # Joints state
 o_shape = env.observation_space.shape  # RGB (W,H,C)
@@ -58,7 +60,9 @@ rollouts = RolloutStorage(args.num_steps,
                           current.state.size()[1],
                           current.target_state.size()[1],
                           current.obs.size()[1:],
-                          ac_shape)
+                          ac_shape,
+                          uint8_obs=args.uint8_obs,
+                          target_obs=targets.obs_tensor() if args.target_index else None)
 
 # === Model ===
 Model = AllPolicy
@@ -95,15 +99,20 @@ print('\nTraining for %d Updates' % args.num_updates)
 
 # Initialize targets and reset env
 env.set_target(targets())  # set initial targets
+current.set_target_index(targets.indices)
 s, s_target, obs, obs_target = env.reset()
+current.apply_target_index()
 current.update(s, s_target, obs, obs_target)
 s, st, o ,ot = current()
-rollouts.first_insert(s, st, o, ot)
+rollouts.first_insert(s, st, o, ot, current.target_index)
 if args.cuda:
     current.cuda()
     rollouts.cuda()
     pi.cuda()
 
+if args.double_buffer:
+    exploration = exploration_async
+
 pi.train()
 MAX_REWARD = -99999
 for j in range(args.num_updates):
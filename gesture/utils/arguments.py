@@ -1,10 +1,17 @@
 import argparse
 import os
+import sys
 import torch
 
 def get_args():
     parser = argparse.ArgumentParser(description='PPOAgent')
     parser.add_argument('--num-proc', type=int, default=4)
+    parser.add_argument('--shared-memory', action='store_true', default=False,
+                        help='workers write state/obs in shared memory instead of sending them through pipes')
+    parser.add_argument('--envs-per-worker', type=int, default=1,
+                        help='number of environments stepped by each worker process (default: 1)')
+    parser.add_argument('--single-world', action='store_true', default=False,
+                        help='simulate all environments in one Roboschool scene in the main process')
 
     # Choregraphe
     parser.add_argument('--PORT', type=str, default=None,
@@ -17,7 +24,11 @@ def get_args():
     parser.add_argument('--video-w', type=int, default=40)
     parser.add_argument('--video-h', type=int, default=40)
     parser.add_argument('--video-c', type=int, default=3)
+    parser.add_argument('--observation-mode', default=None, choices=['state', 'rgb', 'both'],
+                        help='what the env returns, `state` never renders (default: state for MLP policies, else both)')
     parser.add_argument('--MAX_TIME', type=int, default=300)
+    parser.add_argument('--action-repeat', type=int, default=1,
+                        help='physics steps per action, only the last one is rendered. MAX_TIME counts physics steps (default: 1)')
     parser.add_argument('--gravity', type=float, default=9.81)
     parser.add_argument('--power', type=float, default=0.5)
 
@@ -45,10 +56,14 @@ def get_args():
     parser.add_argument('--continue-training', action='store_true', default=False)
     parser.add_argument('--num-frames', type=int, default=int(3e6), help='number of frames to train (default: 3e6)')
     parser.add_argument('--num-steps', type=int, default=2048, help='number of exploration steps in ppo (default: ?)')
+    parser.add_argument('--double-buffer', action='store_true', default=False, help='sample actions for half the envs while the other half simulates')
     parser.add_argument('--batch-size', type=int, default=256, help='ppo batch size (default: 256)')
     parser.add_argument('--max-episode-length', type=int, default=1000, help='maximum steps in one episode (default: 1000)')
     parser.add_argument('--ppo-epoch', type=int, default=8, help='number of ppo epochs, K in paper (default: 8)')
     parser.add_argument('--num-stack', type=int, default=1, help='number of frames to stack (default: 1)')
+    parser.add_argument('--uint8-obs', action='store_true', default=False, help='store rollout observations as uint8 (1/4 of the memory)')
+    parser.add_argument('--target-index', action='store_true', default=False, help='store the target index per step instead of the target observation (num-stack 1), all target observations are kept in cpu memory')
+    parser.add_argument('--worker-targets', action='store_true', default=False, help='env workers open their own copy of the targets, only target indices are sent to them')
     parser.add_argument('--std-start', type=float, default=-0.6, help='std-start (Hyperparams for Roboschool in paper)')
     parser.add_argument('--std-stop', type=float, default=-1.7, help='std stop (Hyperparams for Roboschool in paper)')
     parser.add_argument('--seed', type=int, default=99, help='random seed (default: 99)')
@@ -69,6 +84,8 @@ def get_args():
     parser.add_argument('--strides', nargs='+', type=int, default=[2,2,2])
     parser.add_argument('--cnn-lr', type=float, default=3e-4, help='cnn learning rate (default: 3e-4)')
     parser.add_argument('--epochs', type=int, default=200, help='Epochs used for understanding training(default: 128)')
+    parser.add_argument('--data-workers', type=int, default=0, help='processes gathering understanding batches into shared memory, cpu training (default: 0)')
+    parser.add_argument('--prefetch', type=int, default=2, help='understanding batches loaded ahead of training by a background thread, 0 disables (default: 2)')
     parser.add_argument('--save-interval', type=float, default=10, help='Save interval (default: 10)')
 
     # MLP parts
@@ -101,6 +118,11 @@ def get_args():
     parser.add_argument('--njoints', type=int, default=2, help='Number of joints (default: 2 (Reacher))')
 
     parser.add_argument('--dpoints', type=int, default=500000)
+    parser.add_argument('--chunk-size', type=int, default=64, help='rows per hdf5 chunk when collecting targets (default: 64)')
+    parser.add_argument('--compression', default='none', choices=['none', 'gzip', 'lz4'], help='compression of collected targets, lz4 needs hdf5plugin. Only uncompressed files are memory mapped by lazy loading, compressed ones decompress a whole chunk per random row (default: none)')
+    parser.add_argument('--no-shuffle', action='store_true', default=False, help='disables the hdf5 shuffle filter on collected targets')
+    parser.add_argument('--flush-interval', type=int, default=8192, help='frames per shard between checkpoints when collecting targets (default: 8192)')
+    parser.add_argument('--resume', action='store_true', default=False, help='continue an interrupted target collection from its last checkpoint')
     parser.add_argument('--episodes', type=int, help='complete episode trajectory to gather for mimic', default=10)
     parser.add_argument('--update-target', type=int, default=10, help='Number of frames between target update (default: 10)')
 
@@ -121,6 +143,15 @@ def get_args():
     parser.add_argument('--verbose', action='store_true', default=False)
 
     args = parser.parse_args()
+    if args.single_world and args.double_buffer:
+        # one scene steps all robots at once, there is no half to overlap with
+        parser.error('--double-buffer needs worker processes, it can not be used with --single-world')
+    if args.single_world and (args.shared_memory or args.envs_per_worker != 1):
+        parser.error('--shared-memory and --envs-per-worker configure worker processes, '
+                     'they can not be used with --single-world')
+    if (args.shared_memory or args.data_workers > 0) and sys.version_info < (3, 8):
+        parser.error('--shared-memory and --data-workers use multiprocessing.shared_memory, '
+                     'they require python >= 3.8')
     args.cuda = not args.no_cuda and torch.cuda.is_available()
     args.vis = not args.no_vis
     return args
@@ -0,0 +1,44 @@
+import numpy as np
+try:
+    from multiprocessing import shared_memory  # python >= 3.8
+except ImportError:
+    shared_memory = None
+
+
+def start_resource_tracker():
+    ''' Call before starting processes that attach to SharedArrays.
+    They must share our resource tracker, otherwise they unlink the blocks
+    they attached to when they exit (python bpo-39959) '''
+    assert shared_memory is not None, 'shared memory requires python >= 3.8'
+    from multiprocessing import resource_tracker
+    resource_tracker.ensure_running()
+
+
+class SharedArray(object):
+    """
+    numpy array living in a `multiprocessing.shared_memory` block.
+
+    Pickles as (name, shape, dtype) so sending it through a Pipe makes the
+    receiving process attach to the same memory instead of copying the data.
+    """
+    def __init__(self, shape, dtype=np.float32, name=None):
+        assert shared_memory is not None, 'shared memory requires python >= 3.8'
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = name is None
+        nbytes = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=nbytes)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    def __getstate__(self):
+        return self.shm.name, self.shape, self.dtype.str
+
+    def __setstate__(self, state):
+        name, shape, dtype = state
+        self.__init__(shape, dtype, name)
+
+    def close(self):
+        del self.array  # release the buffer before closing the block
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
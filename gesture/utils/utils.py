@@ -1,6 +1,8 @@
 import pathlib
 import datetime
 import os
+import json
+import shutil
 import h5py
 import numpy as np
 
@@ -41,20 +43,13 @@ def get_model(current, args):
     return pi, Model
 
 def get_targets(args):
-    from agent.memory import Targets
-    from utils.utils import load_dict
+    from agent.memory import TargetLoader
+    njoints = None if args.speed else args.njoints  # args.njoints is initialized in "env_to_args"
     print('\nTraining:', args.train_target_path)
-    train_dict = load_dict(args.train_target_path)
+    targets = TargetLoader(args.train_target_path, njoints)(args.num_proc)
 
     print('\nTesting:', args.test_target_path)
-    test_dict = load_dict(args.test_target_path)
-
-    targets = Targets(args.num_proc, datadict=train_dict)
-    test_targets = Targets(1, datadict=test_dict)
-
-    if not args.speed:
-        targets.remove_speed(args.njoints)  # args.njoints is initialized in "env_to_args"
-        test_targets.remove_speed(args.njoints)
+    test_targets = TargetLoader(args.test_target_path, njoints)(1)
 
     s_target, o_target = targets.random_target()
     s_te, o_te = test_targets.random_target() # check to have same dims as training set
@@ -146,18 +141,231 @@ def save_dict(datadict, filename):
             hdf.create_dataset(k, data=v)
 
 
-def load_dict(filename):
+class DictWriter(object):
+    ''' Streams rows of a dict to h5py, `chunk_size` rows at a time.
+
+    Datasets are created on the first row as resizable and chunked
+    ((chunk_size, *row_shape)), rows are buffered and every full buffer is
+    written as one chunk, so memory use does not grow with the file.
+    Uncompressed datasets with a known number of rows `n` are contiguous
+    instead, which `load_dict(..., lazy=True)` memory maps. Compressed ones
+    are read through h5py, a whole chunk is decompressed per random row.
+    Readable by `load_dict`.
+
+    Args:
+        filename      string: full filepath
+        chunk_size    int: rows per chunk
+        compression   string: 'none', 'gzip' or 'lz4' (needs hdf5plugin)
+        shuffle       bool: hdf5 byte shuffle filter (compresses floats better)
+        n             int: total number of rows, if known
+
+    ex:
+        with DictWriter(filename) as writer:
+            writer.append({'states': s, 'obs': o})
+    '''
+    def __init__(self, filename, chunk_size=64, compression='none', shuffle=True, n=None):
+        self.filename = filename
+        self.chunk_size = chunk_size
+        self.filters = compression_filters(compression, shuffle)
+        self.contiguous = n is not None and not self.filters
+        self.total = n
+        self.hdf = h5py.File(filename, 'w')
+        self.buffers = {}
+        self.n = 0       # rows in buffers
+        self.length = 0  # rows in file
+
+    def append(self, row):
+        ''' row: dict {key: array}, one row per key '''
+        if not self.buffers:
+            self.create(row)
+        for k, v in row.items():
+            self.buffers[k][self.n] = v
+        self.n += 1
+        if self.n == self.chunk_size:
+            self.flush()
+
+    def extend(self, rows):
+        ''' rows: dict {key: array (n, ...)}, e.g. one row per process '''
+        n = len(next(iter(rows.values())))
+        if n and not self.buffers:
+            self.create({k: v[0] for k, v in rows.items()})
+        i = 0
+        while i < n:
+            m = min(n - i, self.chunk_size - self.n)
+            for k, v in rows.items():
+                self.buffers[k][self.n:self.n+m] = v[i:i+m]
+            self.n += m
+            i += m
+            if self.n == self.chunk_size:
+                self.flush()
+
+    def create(self, row):
+        for k, v in row.items():
+            v = np.asarray(v)
+            self.buffers[k] = np.empty((self.chunk_size, *v.shape), dtype=v.dtype)
+            if self.contiguous:
+                self.hdf.create_dataset(k, shape=(self.total, *v.shape), dtype=v.dtype)
+            else:
+                self.hdf.create_dataset(k, shape=(0, *v.shape), maxshape=(None, *v.shape),
+                                        chunks=(self.chunk_size, *v.shape), dtype=v.dtype,
+                                        **self.filters)
+
+    def flush(self):
+        ''' Writes the buffered rows to the file '''
+        if self.n == 0:
+            return
+        for k, buf in self.buffers.items():
+            dset = self.hdf[k]
+            if not self.contiguous:
+                dset.resize(self.length + self.n, axis=0)
+            dset[self.length:self.length+self.n] = buf[:self.n]
+        self.length += self.n
+        self.n = 0
+
+    def close(self):
+        self.flush()
+        self.hdf.close()
+        if self.contiguous and self.length != self.total:
+            raise ValueError('{}: wrote {} of {} rows'.format(self.filename, self.length, self.total))
+
+    def __len__(self):
+        return self.length + self.n
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def compression_filters(compression='none', shuffle=True):
+    ''' kwargs for h5py create_dataset, empty without compression '''
+    if compression in (None, 'none'):
+        return {}
+    filters = {'shuffle': shuffle}
+    if compression == 'gzip':
+        filters.update(compression='gzip', compression_opts=4)
+    elif compression == 'lz4':
+        try:
+            import hdf5plugin
+        except ImportError:
+            raise ImportError('lz4 compression needs hdf5plugin: pip install hdf5plugin')
+        filters.update(hdf5plugin.LZ4())
+    else:
+        raise ValueError('Unknown compression: {}'.format(compression))
+    return filters
+
+
+def load_dict(filename, lazy=False):
     """Load a dict with h5py
     Args:
         filename   string: full filepath
+        lazy       bool: if True nothing is read up front. Contiguous datasets
+                   are returned as read only `np.memmap`s of the file, chunked
+                   or compressed ones as `h5py.Dataset`s (the file stays open).
+                   Both are indexed like arrays (data[i], data[a:b]).
     """
     datadict = {}
+    if lazy:
+        hdf = h5py.File(filename, 'r')
+        for k in hdf.keys():
+            datadict[k] = lazy_dataset(hdf[k], filename)
+        return datadict
     with h5py.File(filename, 'r') as hdf:
         for k in hdf.keys():
             datadict[k] = list(hdf.get(k))
     return datadict
 
 
+def lazy_dataset(dset, filename):
+    ''' np.memmap of a contiguous, uncompressed dataset, else the dataset itself '''
+    offset = dset.id.get_offset()
+    if dset.chunks is None and offset is not None and dset.dtype.kind in 'biuf':
+        return np.memmap(filename, mode='r', dtype=dset.dtype, shape=dset.shape, offset=offset)
+    return dset
+
+
+PREPARED_VERSION = 1
+
+
+def prepared_path(filename, njoints=None):
+    ''' directory of the prepared cache of a target file '''
+    name = os.path.splitext(filename)[0] + '_prepared'
+    if njoints:
+        name += '_nospeed{}'.format(njoints)
+    return name
+
+
+def prepare_targets(filename, njoints=None, chunk=4096):
+    """Writes a training ready cache of a target file, see `load_prepared`.
+    Args:
+        filename   string: h5py target file
+        njoints    int: speed columns to remove from the states (None: keep)
+
+    Cache directory (`prepared_path`):
+        states.npy   float32 (N, S)
+        obs.npy      uint8 (N, C, H, W)
+        meta.json    version, source file size/mtime, njoints, shapes
+    """
+    path = prepared_path(filename, njoints)
+    tmp = path + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    data = load_dict(filename, lazy=True)
+    states, obs = data['states'], data['obs']
+    n = len(states)
+    s_shape = states.shape[1] - (njoints or 0)
+    H, W, C = obs.shape[1:]
+    s_out = np.lib.format.open_memmap(os.path.join(tmp, 'states.npy'), 'w+', np.float32, (n, s_shape))
+    o_out = np.lib.format.open_memmap(os.path.join(tmp, 'obs.npy'), 'w+', np.uint8, (n, C, H, W))
+    for i in range(0, n, chunk):
+        s_out[i:i+chunk] = states[i:i+chunk][:, :s_shape]
+        o_out[i:i+chunk] = np.asarray(obs[i:i+chunk]).transpose(0, 3, 1, 2)
+    s_out.flush()
+    o_out.flush()
+    del s_out, o_out
+    stat = os.stat(filename)
+    meta = {'version': PREPARED_VERSION,
+            'source': os.path.abspath(filename),
+            'source_size': stat.st_size,
+            'source_mtime': stat.st_mtime,
+            'njoints': njoints,
+            'n': n,
+            'state_shape': [s_shape],
+            'obs_shape': [C, H, W]}
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp, path)
+    return path
+
+
+def load_prepared(filename, njoints=None):
+    """Opens the prepared cache of a target file (`prepare_targets`)
+    Args:
+        filename   string: h5py target file
+        njoints    int: speed columns removed from the states (None: kept)
+    Returns:
+        None if there is no up to date cache, else a dict
+        {'states': (N, S) float32, 'obs': (N, H, W, C) uint8, 'meta': dict}
+        memory mapped. 'obs' is a view of the (N, C, H, W) array on disk,
+        `obs.transpose(0, 3, 1, 2)` is contiguous.
+    """
+    path = prepared_path(filename, njoints)
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        return None
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    stat = os.stat(filename)
+    if meta['version'] != PREPARED_VERSION or meta['source_size'] != stat.st_size \
+            or meta['source_mtime'] != stat.st_mtime:
+        print('Prepared targets {} are out of date, not used'.format(path))
+        return None
+    states = np.load(os.path.join(path, 'states.npy'), mmap_mode='r')
+    obs = np.load(os.path.join(path, 'obs.npy'), mmap_mode='r')
+    return {'states': states, 'obs': obs.transpose(0, 2, 3, 1), 'meta': meta}
+
+
 def Conv2d_out_shape(Conv, input_shape, verbose=False, batch=False):
     '''Output of nn.Conv2d.
     #Arguments: